@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""オフライン負荷試験。Discord に接続せず、bot.py の処理を架空のサーバー・プレイヤーで動かす。
+
+  python bench.py --players 2000
+  python bench.py --players 4000 --rest-latency-ms 20 --max-p99-ms 50   # p99 が超えたら終了コード 1
+  python bench.py --players 80 --max-sql-per-match 260 --max-rest-per-match 80   # tests/test_bench.py と同じ予算
+
+参加（handle_match_join）→ マッチ成立（try_match_players_by_rating）→ 5試合の投票
+（ResultButtonView._handle_vote）を流し、フェーズごとの処理数/秒・p50/p99 と
+SQLite の実行文数を表示する。DB は一時ディレクトリに作る（--db で指定も可）。
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+import contextlib
+import io
+from typing import Dict, List, Any, Optional
+
+import discord
+
+# ========= 架空の Discord オブジェクト =========
+# bot.py は isinstance(x, discord.Member / TextChannel / Thread / CategoryChannel) で分岐するので、
+# 本物のクラスを継承し、コンストラクタ（接続状態が必要）は通さずに属性だけ持たせる。
+# プロパティで定義されている属性はクラス属性で上書きしてから値を入れる。
+REST_LATENCY = 0.0
+_ids = itertools.count(10_000_000)
+rest_calls = {"total": 0}
+
+async def _rest_call():
+    """REST 呼び出し1回分（--rest-latency-ms の遅延を模擬）"""
+    rest_calls["total"] += 1
+    if REST_LATENCY:
+        await asyncio.sleep(REST_LATENCY)
+
+class FakeMember(discord.Member):
+    id = 0
+    mention = ""
+    display_name = ""
+    bot = False
+
+    def __new__(cls, uid: int):
+        self = object.__new__(cls)
+        self.id = uid
+        self.mention = f"<@{uid}>"
+        self.display_name = f"player{uid}"
+        return self
+
+    def __init__(self, uid: int):
+        pass
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"<FakeMember {self.id}>"
+
+class FakeThread(discord.Thread):
+    mention = ""
+
+    def __new__(cls, guild: "FakeGuild", name: str):
+        self = object.__new__(cls)
+        self.id = next(_ids)
+        self.name = name
+        self.mention = f"<#{self.id}>"
+        self._fake_guild = guild
+        return self
+
+    def __init__(self, *args):
+        pass
+
+    def __repr__(self):
+        return f"<FakeThread {self.id}>"
+
+    async def send(self, *args, **kwargs):
+        await _rest_call()
+
+    async def add_user(self, user):
+        await _rest_call()
+
+    async def remove_user(self, user):
+        await _rest_call()
+
+    async def delete(self, *args, **kwargs):
+        await _rest_call()
+        self._fake_guild.threads.pop(self.id, None)
+
+class FakeTextChannel(discord.TextChannel):
+    mention = ""
+
+    def __new__(cls, guild: "FakeGuild", name: str, category_id: int):
+        self = object.__new__(cls)
+        self.id = next(_ids)
+        self.name = name
+        self.category_id = category_id
+        self.mention = f"<#{self.id}>"
+        self._fake_guild = guild
+        return self
+
+    def __init__(self, *args):
+        pass
+
+    def __repr__(self):
+        return f"<FakeTextChannel {self.id} {self.name}>"
+
+    async def send(self, *args, **kwargs):
+        await _rest_call()
+
+    async def edit(self, **kwargs):
+        await _rest_call()
+        if "name" in kwargs:
+            self.name = kwargs["name"]
+
+    async def purge(self, **kwargs):
+        await _rest_call()
+        return []
+
+    async def create_thread(self, name: str, **kwargs):
+        await _rest_call()
+        th = FakeThread(self._fake_guild, name)
+        self._fake_guild.threads[th.id] = th
+        return th
+
+    async def delete(self, *args, **kwargs):
+        await _rest_call()
+        self._fake_guild.channels.pop(self.id, None)
+
+class FakeCategory(discord.CategoryChannel):
+    def __new__(cls, cid: int):
+        self = object.__new__(cls)
+        self.id = cid
+        self.name = "bench"
+        return self
+
+    def __init__(self, *args):
+        pass
+
+class FakeGuild:
+    def __init__(self, guild_id: int, category_id: int, members: List[FakeMember]):
+        self.id = guild_id
+        self.default_role = object()
+        self.members_by_id = {m.id: m for m in members}
+        self.category = FakeCategory(category_id)
+        self.channels: Dict[int, Any] = {category_id: self.category}
+        self.threads: Dict[int, FakeThread] = {}
+        self.text_channels: List[FakeTextChannel] = []
+
+    def get_member(self, uid: int) -> Optional[FakeMember]:
+        return self.members_by_id.get(uid)
+
+    def get_channel(self, cid: int):
+        return self.channels.get(cid)
+
+    def get_thread(self, tid: int):
+        return self.threads.get(tid)
+
+    async def create_text_channel(self, name: str, category=None, overwrites=None, **kwargs):
+        await _rest_call()
+        ch = FakeTextChannel(self, name, category.id if category else 0)
+        self.channels[ch.id] = ch
+        return ch
+
+class FakeResponse:
+    async def send_message(self, *args, **kwargs):
+        pass
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild, user: FakeMember, custom_id: str = ""):
+        self.guild = guild
+        self.user = user
+        self.response = FakeResponse()
+        self.data = {"custom_id": custom_id}
+
+# ========= 集計 =========
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+class Phase:
+    def __init__(self, name: str):
+        self.name = name
+        self.samples: List[float] = []
+        self.wall = 0.0
+        self.sql: Dict[str, int] = {}
+
+    def report(self) -> str:
+        n = len(self.samples)
+        rate = n / self.wall if self.wall else 0.0
+        sql_total = sum(self.sql.values())
+        sql_detail = " ".join(f"{k}={v}" for k, v in sorted(self.sql.items(), key=lambda kv: -kv[1]))
+        return (f"{self.name:<10} {n:>7} 回 {self.wall:>7.2f}s {rate:>9.1f}/s "
+                f"p50 {percentile(self.samples, 0.5) * 1000:>7.2f}ms p99 {percentile(self.samples, 0.99) * 1000:>7.2f}ms "
+                f"SQL {sql_total} ({sql_detail})")
+
+sql_counts: Dict[str, int] = {}
+
+def _count_statement(statement: str):
+    # 書き込みスレッド上で呼ばれる（DBExecutor はスレッド1本なので競合しない）
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+    sql_counts[verb] = sql_counts.get(verb, 0) + 1
+
+def _install_trace(conn):
+    conn.set_trace_callback(_count_statement)
+
+def sql_delta(before: Dict[str, int]) -> Dict[str, int]:
+    return {k: v - before.get(k, 0) for k, v in sql_counts.items() if v - before.get(k, 0)}
+
+async def drain(bot_mod):
+    """REST の待ち行列と開始待ちのマッチが空になるまで待つ"""
+    while True:
+        if bot_mod.match_start_tasks:
+            await asyncio.gather(*list(bot_mod.match_start_tasks), return_exceptions=True)
+            continue
+        if any(bot_mod.rest_scheduler.depth.values()):
+            await asyncio.sleep(0.01)
+            continue
+        await asyncio.sleep(0)
+        if not bot_mod.match_start_tasks and not any(bot_mod.rest_scheduler.depth.values()):
+            return
+
+# ========= シナリオ =========
+async def run_bench(args) -> int:
+    import bot as bot_mod
+    # bot.py のログはマッチごとに出るので、計測中は既定で捨てる
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        phases, matches = await run_phases(args, bot_mod)
+
+    # --- 結果 ---
+    print(f"プレイヤー {args.players} 人 / マッチ {matches} / REST 模擬遅延 {args.rest_latency_ms}ms")
+    for p in phases:
+        print(p.report())
+    sql_total = sum(sql_counts.values())
+    print(f"SQL 合計 {sql_total} 文（1マッチあたり {sql_total / max(1, matches):.1f}）"
+          f" / REST 合計 {rest_calls['total']} 回（1マッチあたり {rest_calls['total'] / max(1, matches):.1f}）")
+    print("内部計測（合計の多い順）:")
+    for label, ring in sorted(bot_mod.latency.items(), key=lambda kv: kv[1].total, reverse=True)[:args.top]:
+        p50, p99 = ring.quantiles((0.5, 0.99))
+        print(f"  {label:<40} {ring.count:>7} 回 p50 {p50 * 1000:>7.2f}ms p99 {p99 * 1000:>7.2f}ms 最大 {ring.max * 1000:>7.2f}ms")
+
+    failed = False
+    if args.max_p99_ms is not None:
+        slow = [p.name for p in phases if percentile(p.samples, 0.99) * 1000 > args.max_p99_ms]
+        if slow:
+            print(f"p99 が {args.max_p99_ms}ms を超えました: {', '.join(slow)}")
+            failed = True
+    if args.max_sql_per_match is not None and sql_total / max(1, matches) > args.max_sql_per_match:
+        print(f"1マッチあたりの SQL が {args.max_sql_per_match} 文を超えました")
+        failed = True
+    if args.max_rest_per_match is not None and rest_calls["total"] / max(1, matches) > args.max_rest_per_match:
+        print(f"1マッチあたりの REST が {args.max_rest_per_match} 回を超えました")
+        failed = True
+    return 1 if failed else 0
+
+async def run_phases(args, bot_mod):
+    random.seed(args.seed)
+    await bot_mod.init_db()
+    await bot_mod.db.run(_install_trace)
+    await bot_mod.load_from_db()
+
+    members = [FakeMember(uid) for uid in range(1, args.players + 1)]
+    guild = FakeGuild(bot_mod.GUILD_ID, bot_mod.PARENT_CHANNEL_ID, members)
+    # 勝敗を決めるための隠れた実力（レートはこれに近づいていくはず）
+    skill = {m.id: random.gauss(0, 1) for m in members}
+
+    phases: List[Phase] = []
+
+    # --- 参加 ---
+    ph = Phase("join")
+    before = dict(sql_counts)
+    t0 = time.perf_counter()
+    for m in members:
+        s = time.perf_counter()
+        await bot_mod.handle_match_join(FakeInteraction(guild, m))
+        ph.samples.append(time.perf_counter() - s)
+    ph.wall = time.perf_counter() - t0
+    ph.sql = sql_delta(before)
+    phases.append(ph)
+
+    # --- マッチ成立 ---
+    ph = Phase("matchmake")
+    before = dict(sql_counts)
+    # 1件 = 成立したグループのロビー・スレッド・投票ボタンの準備が終わるまで
+    start_group = bot_mod._start_matched_group
+
+    async def timed_start_group(g, group_ids):
+        s = time.perf_counter()
+        await start_group(g, group_ids)
+        ph.samples.append(time.perf_counter() - s)
+
+    bot_mod._start_matched_group = timed_start_group
+    t0 = time.perf_counter()
+    await bot_mod.try_match_players_by_rating(guild)
+    await drain(bot_mod)
+    ph.wall = time.perf_counter() - t0
+    bot_mod._start_matched_group = start_group
+    ph.sql = sql_delta(before)
+    phases.append(ph)
+    matches = len(bot_mod.current_matches)
+
+    # --- 投票（マッチごとに並行、マッチ内は順番に） ---
+    ph = Phase("vote")
+    before = dict(sql_counts)
+
+    async def play(match_id: int):
+        while match_id in bot_mod.current_matches:
+            mi = bot_mod.current_matches[match_id]
+            game_num = mi["current_game"]
+            team_a, team_b = mi["teams"]["A"], mi["teams"]["B"]
+            diff = sum(skill[u] for u in team_a) - sum(skill[u] for u in team_b)
+            a_wins = random.random() < 1 / (1 + 10 ** (-diff / 2))
+            view = bot_mod.ResultButtonView(match_id=match_id, game_num=game_num)
+            # A と B を交互に投票させ、5票目で確定させる
+            order = [u for pair in zip(team_a, team_b) for u in pair]
+            for uid in order:
+                if match_id not in bot_mod.current_matches or bot_mod.current_matches[match_id]["current_game"] != game_num:
+                    break
+                vote = "win" if (uid in team_a) == a_wins else "lose"
+                inter = FakeInteraction(guild, guild.get_member(uid), view._custom_id(vote))
+                s = time.perf_counter()
+                await view._handle_vote(inter, vote)
+                ph.samples.append(time.perf_counter() - s)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(play(mid) for mid in list(bot_mod.current_matches)))
+    await bot_mod.rating_store.flush()
+    await drain(bot_mod)
+    ph.wall = time.perf_counter() - t0
+    ph.sql = sql_delta(before)
+    phases.append(ph)
+    return phases, matches
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="bot.py のオフライン負荷試験")
+    parser.add_argument("--players", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rest-latency-ms", type=float, default=0.0, help="架空の REST 呼び出し1回あたりの遅延")
+    parser.add_argument("--db", help="使用する DB ファイル（省略時は一時ディレクトリ）")
+    parser.add_argument("--top", type=int, default=15, help="表示する内部計測の件数")
+    parser.add_argument("--verbose", action="store_true", help="bot.py 側のログ（マッチ終了など）も表示する")
+    parser.add_argument("--max-p99-ms", type=float, help="いずれかのフェーズの p99 がこれを超えたら終了コード 1")
+    parser.add_argument("--max-sql-per-match", type=float, help="1マッチあたりの SQL 文数がこれを超えたら終了コード 1")
+    parser.add_argument("--max-rest-per-match", type=float, help="1マッチあたりの REST 呼び出しがこれを超えたら終了コード 1")
+    args = parser.parse_args(argv)
+
+    global REST_LATENCY
+    REST_LATENCY = args.rest_latency_ms / 1000
+    tmp = None
+    if args.db:
+        os.environ["DB_PATH"] = args.db
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        os.environ["DB_PATH"] = os.path.join(tmp.name, "bench.db")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return asyncio.run(run_bench(args))
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+if __name__ == "__main__":
+    sys.exit(main())
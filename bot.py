@@ -1,31 +1,22 @@
 # -*- coding: utf-8 -*-
-import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
-
-# Health check用のダミーWebサーバー
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"OK")
-
-def run_health_server():
-    server = HTTPServer(("0.0.0.0", 8000), HealthHandler)
-    server.serve_forever()
-
-# 別スレッドで起動
-threading.Thread(target=run_health_server, daemon=True).start()
-
-
 import os
 import json
 import random
 import sqlite3
 import asyncio
+import time
+import contextvars
+import functools
+import inspect
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Set, Any, Tuple, Optional
 
-import math  # only used for formatting, not for rating
+import math
+import itertools
 import discord
+from aiohttp import web
 from discord.ext import commands, tasks
 from discord.ui import View, Button
 
@@ -45,6 +36,7 @@ VOTE_THRESHOLD = 5                            # 8人中5票で進行
 DB_PATH = os.getenv("DB_PATH", "/mnt/data/match.db")
 
 MATCHMAKING_INTERVAL = 30
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "8000"))   # ヘルスチェック・メトリクスの待受ポート
 
 # ========= TrueSkill =========
 # pip install trueskill
@@ -69,95 +61,502 @@ intents = discord.Intents.default()
 intents.members = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# ========= 計測 =========
+# ホットパスの所要時間を名前ごとの固定長リングバッファに記録する。
+# 記録は配列への代入だけで、分位点は /perf や /metrics で読むときにだけ計算する。
+LATENCY_WINDOW = 512
+
+class LatencyRing:
+    """直近 LATENCY_WINDOW 件の所要時間（秒）と、起動後の件数・合計・最大"""
+    __slots__ = ("samples", "pos", "count", "total", "max")
+
+    def __init__(self):
+        self.samples = [0.0] * LATENCY_WINDOW
+        self.pos = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.samples[self.pos] = seconds
+        self.pos = (self.pos + 1) % LATENCY_WINDOW
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantiles(self, qs: Tuple[float, ...]) -> List[float]:
+        window = sorted(self.samples[:min(self.count, LATENCY_WINDOW)])
+        if not window:
+            return [0.0 for _ in qs]
+        return [window[min(len(window) - 1, int(q * len(window)))] for q in qs]
+
+latency: Dict[str, LatencyRing] = {}
+
+def record_latency(name: str, seconds: float):
+    ring = latency.get(name)
+    if ring is None:
+        ring = latency[name] = LatencyRing()
+    ring.record(seconds)
+
+class timed_block:
+    """with timed_block("名前"): で囲んだ区間を記録する"""
+    __slots__ = ("name", "t0")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_latency(self.name, time.perf_counter() - self.t0)
+        return False
+
+def timed(name: Optional[str] = None):
+    """関数の所要時間を記録するデコレータ（名前省略時は関数の修飾名）。
+    functools.wraps でシグネチャを保つので、スラッシュコマンドや ui.button の下にも付けられる。"""
+    def decorator(fn):
+        label = name or fn.__qualname__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                t0 = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    record_latency(label, time.perf_counter() - t0)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record_latency(label, time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
 # ========= DB 接続とテーブル =========
-conn = sqlite3.connect(DB_PATH)
-cur = conn.cursor()
-# 任意：ロック耐性を少し改善
-cur.execute("PRAGMA journal_mode=WAL;")
-cur.execute("PRAGMA synchronous=NORMAL;")
-
-# users テーブル（TrueSkill: mu, sigma）
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    mu REAL,
-    sigma REAL,
-    wins INTEGER DEFAULT 0,
-    games INTEGER DEFAULT 0
-)
-""")
-
-# 既存DBからの移行（mu, sigma 列がNULLなら初期化）
-cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
-if cur.fetchone():
-    # 列の存在確認（古い列 str/rd/vol が残っていても無視）
-    cur.execute("PRAGMA table_info(users)")
-    cols = {row[1] for row in cur.fetchall()}
-    if "mu" not in cols:
+class DBExecutor:
+    """SQLite 操作を専用の書き込みスレッド1本で直列に実行する。
+    コルーチンからは await db.run(fn, ...) で呼び、イベントループをディスクI/Oで止めない。
+    fn は書き込みスレッド上で fn(conn, *args) として呼ばれる。
+    import 時には何もせず、open() で初めてスレッドと接続を用意する。"""
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None  # 書き込みスレッド内でのみ使用
+        self._pool: Optional[ThreadPoolExecutor] = None
+        # 計測値: ループ上で同期実行していたらブロックしていた時間の合計
+        self.jobs = 0
+        self.busy_seconds = 0.0
+        self.max_job_seconds = 0.0
+
+    def open(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer",
+                                            initializer=self._connect)
+
+    def _submit(self, fn, args):
+        if self._pool is None:
+            raise RuntimeError("DB が未初期化です（先に init_db() を呼んでください）")
+        return self._pool.submit(self._timed, fn, args)
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path)
+        # 任意：ロック耐性を少し改善
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+
+    def _timed(self, fn, args):
+        t0 = time.perf_counter()
         try:
-            cur.execute("ALTER TABLE users ADD COLUMN mu REAL")
-        except sqlite3.OperationalError:
-            pass
-    if "sigma" not in cols:
+            return fn(self.conn, *args)
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.jobs += 1
+            self.busy_seconds += elapsed
+            self.max_job_seconds = max(self.max_job_seconds, elapsed)
+
+    async def run(self, fn, *args):
+        # 呼び出し側から見た時間（書き込みスレッドの順番待ちを含む）を関数名ごとに記録
+        with timed_block(f"db:{fn.__name__}"):
+            return await asyncio.wrap_future(self._submit(fn, args))
+
+    def run_sync(self, fn, *args):
+        """起動時・終了時などイベントループ外でのみ使う"""
+        with timed_block(f"db:{fn.__name__}"):
+            return self._submit(fn, args).result()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "jobs": self.jobs,
+            "busy_seconds": self.busy_seconds,
+            "max_job_ms": self.max_job_seconds * 1000,
+        }
+
+def _add_column_if_missing(conn: sqlite3.Connection, table: str, column: str, decl: str):
+    cols = {row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column not in cols:
         try:
-            cur.execute("ALTER TABLE users ADD COLUMN sigma REAL")
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
         except sqlite3.OperationalError:
             pass
+
+# ========= スキーマ移行 =========
+# PRAGMA user_version に適用済みの番号を持ち、未適用の分だけを1回ずつ流す。
+# バージョン管理以前の DB（user_version = 0）にも途中まで列が足されていることがあるので、
+# 各移行は IF NOT EXISTS / _add_column_if_missing で既存の状態を許容する。
+def _migrate_1_base(conn: sqlite3.Connection):
+    # users テーブル（TrueSkill: mu, sigma）
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        mu REAL,
+        sigma REAL,
+        wins INTEGER DEFAULT 0,
+        games INTEGER DEFAULT 0
+    )
+    """)
+    # 旧レート方式からの移行（古い列 str/rd/vol が残っていても無視）
+    _add_column_if_missing(conn, "users", "mu", "REAL")
+    _add_column_if_missing(conn, "users", "sigma", "REAL")
     # 既存ユーザーの mu/sigma を初期化（NULL のみに適用）
-    cur.execute("UPDATE users SET mu = COALESCE(mu, ?), sigma = COALESCE(sigma, ?)",
-                (DEFAULT_MU, DEFAULT_SIGMA))
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS matches (
-    match_id INTEGER PRIMARY KEY,
-    guild_id INTEGER,
-    category_id INTEGER,
-    lobby_id INTEGER,
-    players TEXT,
-    current_game INTEGER,
-    votes TEXT,
-    is_dummy INTEGER
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS games (
-    match_id INTEGER,
-    game_num INTEGER,
-    team_a TEXT,
-    team_b TEXT,
-    ch_a_id INTEGER,
-    ch_b_id INTEGER
-)
-""")
+    conn.execute("UPDATE users SET mu = COALESCE(mu, ?), sigma = COALESCE(sigma, ?) WHERE mu IS NULL OR sigma IS NULL",
+                 (DEFAULT_MU, DEFAULT_SIGMA))
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS matches (
+        match_id INTEGER PRIMARY KEY,
+        guild_id INTEGER,
+        category_id INTEGER,
+        lobby_id INTEGER,
+        players TEXT,
+        current_game INTEGER,
+        votes TEXT,
+        is_dummy INTEGER
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS games (
+        match_id INTEGER,
+        game_num INTEGER,
+        team_a TEXT,
+        team_b TEXT,
+        ch_a_id INTEGER,
+        ch_b_id INTEGER
+    )
+    """)
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS waiting_players (
-    id INTEGER PRIMARY KEY
-)
-""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS waiting_players (
+        id INTEGER PRIMARY KEY
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS in_match_players (
+        id INTEGER PRIMARY KEY
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reporter_id INTEGER,
+        target_id INTEGER,
+        reason TEXT,
+        match_id INTEGER,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+def _migrate_2_queue_and_schedule(conn: sqlite3.Connection):
+    # 待機順（seq）列の追加。既存行は NULL のまま先頭扱い
+    _add_column_if_missing(conn, "waiting_players", "seq", "INTEGER")
+    # 5試合分のチーム分け（TEAM_SPLITS 番号の JSON）
+    _add_column_if_missing(conn, "matches", "schedule", "TEXT")
+    # マッチ開始時のレート（{user_id: mu} の JSON）
+    _add_column_if_missing(conn, "matches", "start_ratings", "TEXT")
+
+def _migrate_3_game_rows_and_votes(conn: sqlite3.Connection):
+    # 試合ごとの勝者と更新後レート
+    _add_column_if_missing(conn, "games", "winner", "TEXT")
+    _add_column_if_missing(conn, "games", "ratings", "TEXT")
+    # games は (match_id, game_num) で1行。旧データの重複を除いてから索引を張る
+    conn.execute("""DELETE FROM games WHERE rowid NOT IN
+                    (SELECT MAX(rowid) FROM games GROUP BY match_id, game_num)""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_games_match ON games(match_id, game_num)")
+
+    # 投票は1票1行の追記のみ
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS votes (
+        match_id INTEGER,
+        game_num INTEGER,
+        user_id INTEGER,
+        vote TEXT,
+        PRIMARY KEY (match_id, game_num, user_id)
+    )
+    """)
+
+def _migrate_4_lobby_pool_and_dm(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS lobby_pool (
+        channel_id INTEGER PRIMARY KEY
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dm_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        payload TEXT,
+        attempts INTEGER DEFAULT 0,
+        next_attempt REAL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_dm_outbox_next ON dm_outbox(next_attempt)")
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dm_blocked (
+        user_id INTEGER PRIMARY KEY,
+        blocked_at REAL
+    )
+    """)
+
+def _migrate_5_game_ledger(conn: sqlite3.Connection):
+    # 決着した試合の追記専用台帳（games はマッチ終了で消えるので、レート再計算はこちらを使う）
+    #   team_a / team_b: ユーザーID の JSON、winner: "A" / "B" / "draw"
+    #   pre / post: {user_id: [mu, sigma]} の JSON
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS game_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        match_id INTEGER,
+        game_num INTEGER,
+        played_at REAL,
+        team_a TEXT,
+        team_b TEXT,
+        winner TEXT,
+        pre TEXT,
+        post TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_game_ledger_match ON game_ledger(match_id, game_num)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_game_ledger_played ON game_ledger(played_at)")
+
+# 追加は末尾にのみ行う（番号 = 添字 + 1 が user_version になる）
+MIGRATIONS = [
+    _migrate_1_base,
+    _migrate_2_queue_and_schedule,
+    _migrate_3_game_rows_and_votes,
+    _migrate_4_lobby_pool_and_dm,
+    _migrate_5_game_ledger,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def _migrate(conn: sqlite3.Connection) -> Tuple[int, int]:
+    """未適用の移行を順に流す。各移行とバージョン更新は同じトランザクションで確定する"""
+    before = conn.execute("PRAGMA user_version").fetchone()[0]
+    if before > SCHEMA_VERSION:
+        raise RuntimeError(f"DB のスキーマ v{before} はこの bot（v{SCHEMA_VERSION}）より新しいです")
+    for version in range(before + 1, SCHEMA_VERSION + 1):
+        conn.execute("BEGIN")
+        try:
+            MIGRATIONS[version - 1](conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return before, SCHEMA_VERSION
+
+async def init_db():
+    """DB 接続を開き、スキーマを最新にする。起動時に1回だけ（setup_hook から）呼ぶ"""
+    t0 = time.perf_counter()
+    db.open()
+    before, after = await db.run(_migrate)
+    ms = (time.perf_counter() - t0) * 1000
+    if before == after:
+        print(f"DB スキーマ: v{after}（移行なし, {ms:.1f}ms）")
+    else:
+        print(f"DB スキーマ: v{before} → v{after}（{ms:.1f}ms）")
+
+db = DBExecutor(DB_PATH)
+
+# ========= データ構造 =========
+class _SkipNode:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key: Any, level: int):
+        self.key = key
+        self.next: List[Optional["_SkipNode"]] = [None] * level
+        self.width: List[int] = [1] * level
+
+
+class IndexedSkipList:
+    """順序統計付きスキップリスト。挿入・削除・順位・k番目の取得がすべて O(log n)。
+    width[i] は「そのリンクで飛び越す要素数」（末尾の番兵までを含む）。"""
+    MAX_LEVEL = 24
+
+    def __init__(self):
+        self.head = _SkipNode(None, self.MAX_LEVEL)
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _random_level(self) -> int:
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+
+    def _find(self, key: Any) -> Tuple[List[_SkipNode], List[int]]:
+        """各レベルで key 未満の最後のノードとその位置（先頭=0）を返す"""
+        chain: List[_SkipNode] = [self.head] * self.MAX_LEVEL
+        chain_pos = [0] * self.MAX_LEVEL
+        node, pos = self.head, 0
+        for i in reversed(range(self.MAX_LEVEL)):
+            while node.next[i] is not None and node.next[i].key < key:
+                pos += node.width[i]
+                node = node.next[i]
+            chain[i] = node
+            chain_pos[i] = pos
+        return chain, chain_pos
+
+    def insert(self, key: Any):
+        chain, chain_pos = self._find(key)
+        pos = chain_pos[0]
+        level = self._random_level()
+        new = _SkipNode(key, level)
+        for i in range(level):
+            prev = chain[i]
+            new.next[i] = prev.next[i]
+            prev.next[i] = new
+            new.width[i] = prev.width[i] - (pos - chain_pos[i])
+            prev.width[i] = pos + 1 - chain_pos[i]
+        for i in range(level, self.MAX_LEVEL):
+            chain[i].width[i] += 1
+        self.size += 1
+
+    def remove(self, key: Any):
+        chain, _ = self._find(key)
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        for i in range(self.MAX_LEVEL):
+            if chain[i].next[i] is target:
+                chain[i].width[i] += target.width[i] - 1
+                chain[i].next[i] = target.next[i]
+            else:
+                chain[i].width[i] -= 1
+        self.size -= 1
+
+    def index(self, key: Any) -> Optional[int]:
+        """key の0始まりの位置。存在しなければ None"""
+        chain, chain_pos = self._find(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            return None
+        return chain_pos[0]
+
+    def _node_at(self, index: int) -> Optional[_SkipNode]:
+        if index < 0 or index >= self.size:
+            return None
+        target = index + 1
+        node, pos = self.head, 0
+        for i in reversed(range(self.MAX_LEVEL)):
+            while node.next[i] is not None and pos + node.width[i] <= target:
+                pos += node.width[i]
+                node = node.next[i]
+        return node
+
+    def __getitem__(self, index: int) -> Any:
+        node = self._node_at(index)
+        if node is None:
+            raise IndexError(index)
+        return node.key
+
+    def slice(self, start: int, count: int) -> List[Any]:
+        """start 番目から最大 count 件（O(log n + count)）"""
+        res: List[Any] = []
+        node = self._node_at(max(0, start))
+        while node is not None and len(res) < count:
+            res.append(node.key)
+            node = node.next[0]
+        return res
+
+    def bisect_left(self, key: Any) -> int:
+        """key 未満の要素数（key が無くなっていても位置が決まる）"""
+        _, chain_pos = self._find(key)
+        return chain_pos[0]
+
+    def after(self, key: Any, count: int) -> List[Any]:
+        """key より大きい要素を小さい順に最大 count 件（O(log n + count)）"""
+        chain, _ = self._find(key)
+        node = chain[0].next[0]
+        while node is not None and node.key == key:
+            node = node.next[0]
+        res: List[Any] = []
+        while node is not None and len(res) < count:
+            res.append(node.key)
+            node = node.next[0]
+        return res
+
+    def before(self, key: Any, count: int) -> List[Any]:
+        """key 未満の要素のうち、key に近い側から最大 count 件を小さい順に"""
+        pos = self.bisect_left(key)
+        return self.slice(max(0, pos - count), min(count, pos))
+
+
+class WaitingQueue:
+    """待機リスト。参加順（FIFO）を保ちつつ mu 降順の索引も持つ。
+    所属判定 O(1)、追加・削除 O(log n)、上位 k 人の取り出し O(k log n)。"""
+    def __init__(self):
+        self.entries: Dict[int, Tuple[float, int, int]] = {}  # user_id -> (-mu, seq, user_id)。dict の順序 = 参加順
+        self.by_rating = IndexedSkipList()
+        self.seq = 0  # 参加順の採番（DB の waiting_players.seq）
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.entries
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def add(self, user_id: int, mu: float, seq: Optional[int] = None) -> int:
+        if seq is None:
+            seq = self.seq + 1
+        self.seq = max(self.seq, seq)
+        key = (-mu, seq, user_id)
+        self.entries[user_id] = key
+        self.by_rating.insert(key)
+        return seq
+
+    def remove(self, user_id: int):
+        key = self.entries.pop(user_id)
+        self.by_rating.remove(key)
+
+    def peek_top(self, k: int) -> List[int]:
+        """レート上位 k 人（取り出さない）"""
+        return [uid for _, _, uid in self.by_rating.slice(0, k)]
+
+    def pop_top(self, k: int) -> List[int]:
+        """レート上位 k 人を取り出す（同レートは先に参加した人を優先）"""
+        group = self.peek_top(k)
+        for uid in group:
+            self.remove(uid)
+        return group
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS in_match_players (
-    id INTEGER PRIMARY KEY
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS reports (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    reporter_id INTEGER,
-    target_id INTEGER,
-    reason TEXT,
-    match_id INTEGER,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-)
-""")
-conn.commit()
 
 # ========= メモリ内データ =========
 user_data: Dict[int, int] = {}  # 表示用（= mu の整数丸め）
-waiting_players: List[int] = []
+waiting_players = WaitingQueue()
 current_matches: Dict[int, Dict[str, Any]] = {}
 in_match_players: Set[int] = set()
 
@@ -167,8 +566,190 @@ class DummyMember:
         self.id = -idx  # 負数IDで区別
         self.mention = f"Dummy{idx}"
 
+# ========= Discord REST スケジューラ =========
+# 優先度レーン（小さいほど先に実行）
+LANE_INTERACTION = 0  # ボタン操作などへの返答に直結するロビー投稿
+LANE_MATCH = 1        # ロビー・スレッド作成などマッチ進行に必要な操作
+LANE_BACKGROUND = 2   # DM・ログ・チャンネル削除などの後片付け
+LANE_NAMES = {LANE_INTERACTION: "interaction", LANE_MATCH: "match", LANE_BACKGROUND: "background"}
+
+REST_WORKERS = 4             # interaction/match レーンを処理する並列数
+REST_BACKGROUND_WORKERS = 2  # background レーン専用の並列数（前景の枠は使わない）
+
+class RestScheduler:
+    """Discord への REST 呼び出しを優先度レーンに積んで順に実行する。
+    interaction.response.* は3秒以内の返答が必要で Bot のレート制限とも別枠なので、ここを通さず直接呼ぶ。
+    background レーンは専用ワーカーで処理するため、結果配信が大量に溜まっても新しいマッチの準備を待たせない。
+    同じ key を持つ未実行の操作は1回にまとめる（coalesce）。"""
+    def __init__(self):
+        self.foreground: Optional[asyncio.PriorityQueue] = None
+        self.background: Optional[asyncio.PriorityQueue] = None
+        self.workers: List[asyncio.Task] = []
+        self.seq = itertools.count()
+        self.pending: Dict[Any, asyncio.Future] = {}
+        self.depth = {lane: 0 for lane in LANE_NAMES}
+        self.completed = {lane: 0 for lane in LANE_NAMES}
+        self.failed = {lane: 0 for lane in LANE_NAMES}
+        self.coalesced = 0
+        self.match_calls: Dict[int, int] = {}
+        self.recent_match_calls: deque = deque(maxlen=50)
+
+    def _start(self):
+        self.foreground = asyncio.PriorityQueue()
+        self.background = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self._worker(self.foreground)) for _ in range(REST_WORKERS)]
+        self.workers += [asyncio.create_task(self._worker(self.background)) for _ in range(REST_BACKGROUND_WORKERS)]
+
+    def submit(self, lane: int, factory, key: Any = None) -> asyncio.Future:
+        """factory() が返すコルーチンを lane に積み、結果の Future を返す"""
+        if not self.workers:
+            self._start()
+        if key is not None and key in self.pending:
+            self.coalesced += 1
+            # まとめた Future は複数の呼び出し元で共有するので、誰かがキャンセルされても他を巻き込まない
+            return asyncio.shield(self.pending[key])
+        fut = asyncio.get_running_loop().create_future()
+        queue = self.background if lane >= LANE_BACKGROUND else self.foreground
+        queue.put_nowait((lane, next(self.seq), factory, fut, key, time.perf_counter()))
+        self.depth[lane] += 1
+        tag = rest_match_tag.get()
+        if tag is not None:
+            self.match_calls[tag] = self.match_calls.get(tag, 0) + 1
+        if key is not None:
+            self.pending[key] = fut
+            return asyncio.shield(fut)
+        return fut
+
+    def finish_match(self, match_id: int) -> int:
+        """マッチで使った REST 操作数を取り出して記録する"""
+        calls = self.match_calls.pop(match_id, 0)
+        self.recent_match_calls.append(calls)
+        return calls
+
+    def discard_match(self, match_id: int):
+        """開始できなかったマッチなどの回数を、平均に入れずに捨てる"""
+        self.match_calls.pop(match_id, None)
+
+    async def run(self, lane: int, factory, key: Any = None):
+        return await self.submit(lane, factory, key)
+
+    def fire(self, lane: int, factory, key: Any = None):
+        """結果を待たない投げっぱなし実行（失敗はログのみ）"""
+        self.submit(lane, factory, key).add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(fut: asyncio.Future):
+        if not fut.cancelled() and fut.exception() is not None:
+            print(f"REST 操作失敗: {fut.exception()!r}")
+
+    async def _worker(self, queue: asyncio.PriorityQueue):
+        while True:
+            lane, _, factory, fut, key, queued_at = await queue.get()
+            self.depth[lane] -= 1
+            if key is not None and self.pending.get(key) is fut:
+                del self.pending[key]
+            if fut.done():
+                continue
+            t0 = time.perf_counter()
+            record_latency(f"rest_wait:{LANE_NAMES[lane]}", t0 - queued_at)
+            # 実行中に呼び出し元がキャンセルされると fut は既に終わっているので、結果は数えるだけにする
+            try:
+                result = await factory()
+            except Exception as e:
+                self.failed[lane] += 1
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                self.completed[lane] += 1
+                if not fut.done():
+                    fut.set_result(result)
+            record_latency(f"rest:{LANE_NAMES[lane]}", time.perf_counter() - t0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": {LANE_NAMES[l]: n for l, n in self.depth.items()},
+            "completed": {LANE_NAMES[l]: n for l, n in self.completed.items()},
+            "failed": {LANE_NAMES[l]: n for l, n in self.failed.items()},
+            "coalesced": self.coalesced,
+            "per_match_avg": (sum(self.recent_match_calls) / len(self.recent_match_calls)
+                              if self.recent_match_calls else 0.0),
+        }
+
+rest_scheduler = RestScheduler()
+# 実行中のタスクが処理しているマッチ。ここで積まれた REST 操作はそのマッチの回数として数える
+rest_match_tag: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("rest_match_tag", default=None)
+
 # ========= ユーティリティ =========
 
+MEMBER_NAME_GRAM = 3  # 索引に入れる n-gram の最大長
+
+class MemberNameIndex:
+    """casefold した display_name / name の 1〜MEMBER_NAME_GRAM 文字の n-gram → user_id の転置索引（Bot は除く）。
+    部分一致は、クエリが短ければその n-gram の集合がそのまま答えで、長ければ 3-gram の積集合を候補にして確かめる。"""
+    def __init__(self):
+        self.names: Dict[int, Tuple[str, ...]] = {}
+        self.postings: Dict[str, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @staticmethod
+    def _grams(names: Tuple[str, ...]) -> Set[str]:
+        return {name[i:i + n]
+                for name in names
+                for n in range(1, MEMBER_NAME_GRAM + 1)
+                for i in range(len(name) - n + 1)}
+
+    def build(self, members: List[discord.Member]):
+        self.names.clear()
+        self.postings.clear()
+        for m in members:
+            self.add(m)
+
+    def add(self, member: discord.Member):
+        if member.bot:
+            return
+        names = tuple({member.display_name.casefold(), member.name.casefold()})
+        if self.names.get(member.id) == names:
+            return
+        self.remove(member.id)
+        self.names[member.id] = names
+        for gram in self._grams(names):
+            self.postings.setdefault(gram, set()).add(member.id)
+
+    def remove(self, user_id: int):
+        names = self.names.pop(user_id, None)
+        if names is None:
+            return
+        for gram in self._grams(names):
+            ids = self.postings.get(gram)
+            if ids is not None:
+                ids.discard(user_id)
+                if not ids:
+                    del self.postings[gram]
+
+    def search(self, query: str) -> List[int]:
+        """名前のどちらかに query を含む user_id（ID 順）"""
+        q = query.casefold()
+        if not q:
+            return sorted(self.names)
+        if len(q) <= MEMBER_NAME_GRAM:
+            return sorted(self.postings.get(q, ()))
+        postings = sorted((self.postings.get(q[i:i + MEMBER_NAME_GRAM], set())
+                           for i in range(len(q) - MEMBER_NAME_GRAM + 1)), key=len)
+        candidates = set.intersection(*postings) if postings[0] else set()
+        return sorted(uid for uid in candidates if any(q in name for name in self.names[uid]))
+
+member_name_indexes: Dict[int, MemberNameIndex] = {}  # guild_id -> 索引
+
+def member_name_index(guild: discord.Guild) -> MemberNameIndex:
+    index = member_name_indexes.get(guild.id)
+    if index is None:
+        # on_ready より前に呼ばれた場合など、まだ無ければここで作る
+        index = member_name_indexes[guild.id] = MemberNameIndex()
+        index.build(guild.members)
+    return index
+
 def find_member_by_input(guild: discord.Guild, input_str: str | None, fallback_user: discord.User):
     """入力文字列からMemberを探す（display_name/username 部分一致、ID、メンション対応）。無指定なら自分"""
     if input_str is None:
@@ -180,11 +761,8 @@ def find_member_by_input(guild: discord.Guild, input_str: str | None, fallback_u
         if uid.isdigit():
             return guild.get_member(int(uid))
 
-    # display_name / username 部分一致検索
-    matches = [
-        m for m in guild.members
-        if not m.bot and (input_str.lower() in m.display_name.lower() or input_str.lower() in m.name.lower())
-    ]
+    # display_name / username 部分一致検索（名前索引から候補だけを引く）
+    matches = [m for m in map(guild.get_member, member_name_index(guild).search(input_str)) if m is not None]
     if len(matches) == 1:
         return matches[0]
     elif len(matches) > 1:
@@ -217,9 +795,57 @@ PRESET_TEAMS = [
     ([1, 4, 6, 8], [2, 3, 5, 7])   # 17/19
 ]
 
-def get_preset_teams(players: List[Any], game_num: int) -> Dict[str, List[Any]]:
+# ========= チーム分けエンジン =========
+# 8人を 4v4 に分ける全 35 通り（1番を常にチームAに固定して左右対称の重複を除く）。番号は PRESET_TEAMS と同じ1始まり
+TEAM_SPLITS: List[Tuple[List[int], List[int]]] = [
+    ([1, *rest], [n for n in range(2, PLAYERS_NEEDED + 1) if n not in rest])
+    for rest in itertools.combinations(range(2, PLAYERS_NEEDED + 1), TEAM_SIZE - 1)
+]
+_PAIR_INDEX = {pair: i for i, pair in enumerate(itertools.combinations(range(1, PLAYERS_NEEDED + 1), 2))}
+# 各分け方で味方になるペア（ペア番号のタプル）
+_SPLIT_PAIRS: List[Tuple[int, ...]] = [
+    tuple(_PAIR_INDEX[pair] for team in split for pair in itertools.combinations(team, 2))
+    for split in TEAM_SPLITS
+]
+# 同じ相手と再び味方になるごとに引く値（マッチ品質は最良=1.0 に正規化して比較する）
+TEAM_ROTATION_PENALTY = 0.08
+
+def plan_team_schedule(ratings: List[trueskill.Rating], games: int = TOTAL_GAMES) -> List[int]:
+    """全分け方をまとめて採点し、品質の高さと味方の入れ替わりを両立する games 試合分の
+    TEAM_SPLITS 番号を返す。2チーム戦の品質は全員の sigma が共通項になるため、
+    チームの mu 合計差だけで決まる（ts.quality と同じ式）。"""
+    mus = [r.mu for r in ratings]
+    total_mu = sum(mus)
+    denom = PLAYERS_NEEDED * ts.beta ** 2 + sum(r.sigma ** 2 for r in ratings)
+    quality = [
+        math.exp(-(2 * sum(mus[n - 1] for n in team_a) - total_mu) ** 2 / (2 * denom))
+        for team_a, _ in TEAM_SPLITS
+    ]
+    # 最良の分け方を 1.0 に揃える（絶対値はメンバーの sigma 次第なので、ペナルティの効き方を一定にするため）
+    best_quality = max(quality) or 1.0
+    quality = [q / best_quality for q in quality]
+    pair_uses = [0] * len(_PAIR_INDEX)
+    schedule: List[int] = []
+    for _ in range(games):
+        best, best_score = -1, -math.inf
+        for idx, pairs in enumerate(_SPLIT_PAIRS):
+            if idx in schedule:
+                continue
+            score = quality[idx] - TEAM_ROTATION_PENALTY * sum(pair_uses[p] for p in pairs)
+            if score > best_score:
+                best, best_score = idx, score
+        schedule.append(best)
+        for p in _SPLIT_PAIRS[best]:
+            pair_uses[p] += 1
+    return schedule
+
+def get_preset_teams(players: List[Any], game_num: int, schedule: Optional[List[int]] = None) -> Dict[str, List[Any]]:
     index_map = {i+1: players[i] for i in range(len(players))}
-    team_a_nums, team_b_nums = PRESET_TEAMS[game_num - 1]
+    if schedule:
+        team_a_nums, team_b_nums = TEAM_SPLITS[schedule[game_num - 1]]
+    else:
+        # 分け方が未計算のマッチ（旧データ）は固定順
+        team_a_nums, team_b_nums = PRESET_TEAMS[game_num - 1]
     team_a = [index_map[n] for n in team_a_nums]
     team_b = [index_map[n] for n in team_b_nums]
     return {"A": team_a, "B": team_b}
@@ -237,7 +863,8 @@ def build_overwrites_for_team(guild: discord.Guild, members: List[discord.Member
 async def create_text_channel_safe(guild: discord.Guild, name: str, category: discord.CategoryChannel,
                                    overwrites: Dict[Any, discord.PermissionOverwrite] = None) -> discord.TextChannel | None:
     try:
-        ch = await guild.create_text_channel(name=name, category=category, overwrites=overwrites)
+        ch = await rest_scheduler.run(LANE_MATCH, lambda: guild.create_text_channel(
+            name=name, category=category, overwrites=overwrites))
         return ch
     except discord.errors.Forbidden:
         print("Missing Permissions: チャンネル作成権限が不足しています（Manage Channels など）。")
@@ -280,86 +907,349 @@ def deserialize_players(players_json: str) -> List[Any]:
         pass
     return res
 
+# ========= 順位インデックス =========
+class LeaderboardIndex:
+    """mu 降順の順位表。RatingStore から差分更新される"""
+    def __init__(self):
+        self.keys: Dict[int, Tuple[float, int]] = {}
+        self.order = IndexedSkipList()
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def update(self, user_id: int, mu: float):
+        key = (-mu, user_id)
+        old = self.keys.get(user_id)
+        if old == key:
+            return
+        if old is not None:
+            self.order.remove(old)
+        self.order.insert(key)
+        self.keys[user_id] = key
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """1始まりの順位"""
+        key = self.keys.get(user_id)
+        if key is None:
+            return None
+        idx = self.order.index(key)
+        return None if idx is None else idx + 1
+
+    # ページ取得。行は (user_id, mu) で、前後のページは表示中の端の行をカーソルにして続きから取る
+    @staticmethod
+    def _rows(keys: List[Tuple[float, int]]) -> List[Tuple[int, float]]:
+        return [(uid, -neg_mu) for neg_mu, uid in keys]
+
+    def page(self, start_rank: int, count: int) -> List[Tuple[int, float]]:
+        """start_rank 位から count 人分の (user_id, mu)"""
+        return self._rows(self.order.slice(start_rank - 1, count))
+
+    def page_after(self, row: Tuple[int, float], count: int) -> List[Tuple[int, float]]:
+        """row より下の count 人分（row の人のレートがその後動いていても、row の位置の続きから）"""
+        return self._rows(self.order.after((-row[1], row[0]), count))
+
+    def page_before(self, row: Tuple[int, float], count: int) -> List[Tuple[int, float]]:
+        """row より上の count 人分（昇順）"""
+        return self._rows(self.order.before((-row[1], row[0]), count))
+
+    def rank_of_row(self, row: Tuple[int, float]) -> int:
+        """row の位置の1始まりの順位"""
+        return self.order.bisect_left((-row[1], row[0])) + 1
+
+leaderboard = LeaderboardIndex()
+
 # ========= TrueSkill 用 DB ヘルパ =========
+RATING_FLUSH_INTERVAL = 5  # dirty なレートを users テーブルへ書き戻す間隔（秒）
+
+class RatingStore:
+    """全ユーザーの (mu, sigma, wins, games) をメモリに保持する。
+    読み出しはメモリのみで完結し、変更は dirty として溜めて flush() でまとめて書き戻す。"""
+    def __init__(self):
+        self.rows: Dict[int, List[Any]] = {}  # user_id -> [mu, sigma, wins, games]
+        self.dirty: Set[int] = set()
+        self.pending_ledger: List[Tuple] = []  # まだ書けていない game_ledger の行
+        self.pending_results: List[Tuple] = []  # まだ書けていない games の勝敗（台帳と同じトランザクションで書く）
+
+    def _put(self, user_id: int, mu: float, sigma: float, wins: int, games: int):
+        self.rows[user_id] = [mu, sigma, wins, games]
+        user_data[user_id] = int(round(mu))
+        leaderboard.update(user_id, mu)
+
+    async def load(self):
+        self.load_rows(await db.run(_select_users))
+
+    def load_rows(self, rows: List[Tuple]):
+        """users テーブルの全行を取り込む（未書き戻しの変更は上書きしない）"""
+        for uid, mu, sigma, wins, games in rows:
+            if uid in self.dirty:
+                continue
+            self._put(uid,
+                      DEFAULT_MU if mu is None else mu,
+                      DEFAULT_SIGMA if sigma is None else sigma,
+                      wins or 0, games or 0)
+
+    def ensure(self, user_id: int) -> List[Any]:
+        row = self.rows.get(user_id)
+        if row is None:
+            self._put(user_id, DEFAULT_MU, DEFAULT_SIGMA, 0, 0)
+            self.dirty.add(user_id)
+            row = self.rows[user_id]
+        return row
+
+    def get(self, user_id: int) -> trueskill.Rating:
+        mu, sigma, _, _ = self.ensure(user_id)
+        return ts.Rating(mu=mu, sigma=sigma)
+
+    def set(self, user_id: int, rating: trueskill.Rating):
+        row = self.ensure(user_id)
+        row[0], row[1] = rating.mu, rating.sigma
+        user_data[user_id] = int(round(rating.mu))
+        leaderboard.update(user_id, rating.mu)
+        self.dirty.add(user_id)
+
+    def record_game(self, user_id: int, won: bool):
+        row = self.ensure(user_id)
+        row[3] += 1
+        if won:
+            row[2] += 1
+        self.dirty.add(user_id)
+
+    def win_stats(self, user_id: int) -> Tuple[int, int]:
+        _, _, wins, games = self.ensure(user_id)
+        return wins, games
+
+    async def apply_game(self, ratings: Dict[int, trueskill.Rating], winners: Set[int],
+                         ledger_row: Optional[Tuple] = None, game_result: Optional[Tuple] = None):
+        """1試合分のレートと勝敗数を反映し、台帳の行・試合の勝敗と一緒に1トランザクションで書き込む"""
+        for uid, rating in ratings.items():
+            self.set(uid, rating)
+            self.record_game(uid, uid in winners)
+        if ledger_row is not None:
+            self.pending_ledger.append(ledger_row)
+        if game_result is not None:
+            self.pending_results.append(game_result)
+        try:
+            await self._write(list(ratings))
+        except Exception as e:
+            # メモリには反映済みで、書けなかった行は pending に戻っている。次回の flush で同じトランザクションとして書き直す
+            print(f"試合結果の書き込み失敗（次回の書き戻しで再送）: {e}")
+
+    async def flush(self):
+        """dirty なユーザーを1トランザクションでまとめて書き戻す"""
+        if self.dirty or self.pending_ledger or self.pending_results:
+            await self._write(list(self.dirty))
+
+    def flush_sync(self):
+        """終了処理用（イベントループ停止後）"""
+        if self.dirty or self.pending_ledger or self.pending_results:
+            db.run_sync(_upsert_users, [(uid, *self.rows[uid]) for uid in self.dirty],
+                        self.pending_ledger, self.pending_results)
+            self.dirty.clear()
+            self.pending_ledger = []
+            self.pending_results = []
+
+    async def _write(self, user_ids: List[int]):
+        # 書き込み中に再度変更されたユーザーを取りこぼさないよう、先に dirty から外す
+        batch = [(uid, *self.rows[uid]) for uid in user_ids]
+        ledger, self.pending_ledger = self.pending_ledger, []
+        results, self.pending_results = self.pending_results, []
+        self.dirty.difference_update(user_ids)
+        try:
+            await db.run(_upsert_users, batch, ledger, results)
+        except Exception:
+            # ロールバック済みなので次回 flush で再送（台帳の行・勝敗も同じトランザクションで書き直す）
+            self.dirty.update(user_ids)
+            self.pending_ledger = ledger + self.pending_ledger
+            self.pending_results = results + self.pending_results
+            raise
+
+def _select_users(conn: sqlite3.Connection) -> List[Tuple]:
+    return conn.execute("SELECT user_id, mu, sigma, wins, games FROM users").fetchall()
+
+def _upsert_users(conn: sqlite3.Connection, batch: List[Tuple], ledger_rows: List[Tuple] = (),
+                  game_results: List[Tuple] = ()):
+    with conn:
+        conn.executemany("""INSERT INTO users (user_id, mu, sigma, wins, games) VALUES (?,?,?,?,?)
+                            ON CONFLICT(user_id) DO UPDATE SET
+                                mu=excluded.mu, sigma=excluded.sigma,
+                                wins=excluded.wins, games=excluded.games""", batch)
+        if ledger_rows:
+            conn.executemany("""INSERT INTO game_ledger (match_id, game_num, played_at, team_a, team_b, winner, pre, post)
+                                VALUES (?,?,?,?,?,?,?,?)""", ledger_rows)
+        for row in game_results:
+            _write_game_result(conn, *row)
+
+rating_store = RatingStore()
+
+@timed()
 def ensure_user_row(user_id: int):
-    cur.execute("SELECT mu, sigma FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    if row is None:
-        cur.execute("INSERT INTO users (user_id, mu, sigma) VALUES (?,?,?)",
-                    (user_id, DEFAULT_MU, DEFAULT_SIGMA))
-        conn.commit()
-        user_data[user_id] = int(round(DEFAULT_MU))
-        return
-    mu, sigma = row
-    if mu is None or sigma is None:
-        mu = DEFAULT_MU if mu is None else mu
-        sigma = DEFAULT_SIGMA if sigma is None else sigma
-        cur.execute("UPDATE users SET mu=?, sigma=? WHERE user_id=?", (mu, sigma, user_id))
-        conn.commit()
-    user_data[user_id] = int(round(mu if mu is not None else DEFAULT_MU))
+    rating_store.ensure(user_id)
 
 def get_user_trueskill(user_id: int) -> trueskill.Rating:
-    ensure_user_row(user_id)
-    cur.execute("SELECT mu, sigma FROM users WHERE user_id=?", (user_id,))
-    mu, sigma = cur.fetchone()
-    return ts.Rating(mu=mu, sigma=sigma)
+    return rating_store.get(user_id)
 
+@timed()
 def set_user_trueskill(user_id: int, rating: trueskill.Rating):
-    cur.execute("UPDATE users SET mu=?, sigma=? WHERE user_id=?", (rating.mu, rating.sigma, user_id))
-    conn.commit()
-    user_data[user_id] = int(round(rating.mu))
+    rating_store.set(user_id, rating)
+
+def rating_of_player(p: Any) -> trueskill.Rating:
+    """マッチの players 要素（Member / int / DummyMember）のレート。ダミー等は初期値"""
+    if isinstance(p, discord.Member):
+        return get_user_trueskill(p.id)
+    if isinstance(p, int) and p > 0:
+        return get_user_trueskill(p)
+    return ts.Rating()
 
 def to_display(mu: float) -> float:
     return round(mu * 40 + 1100, 1)
 
 
 # ========= DB 保存/読込 =========
-def save_waiting_players():
-    cur.execute("DELETE FROM waiting_players")
-    if waiting_players:
-        cur.executemany("INSERT INTO waiting_players (id) VALUES (?)", [(p,) for p in waiting_players])
-    conn.commit()
-
-def save_in_match_players():
-    cur.execute("DELETE FROM in_match_players")
-    if in_match_players:
-        cur.executemany("INSERT INTO in_match_players (id) VALUES (?)", [(p,) for p in in_match_players])
-    conn.commit()
-
-def save_match(match_id: int):
-    if match_id not in current_matches:
-        return
+# 書き込みスレッド側で実行される関数（引数はイベントループ側で確定させたスナップショット）
+# 待機/対戦中リストは全件書き直さず、変化した行だけを記録する
+def _insert_waiting(conn: sqlite3.Connection, user_id: int, seq: int):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO waiting_players (id, seq) VALUES (?,?)", (user_id, seq))
+
+def _insert_ids_by(conn: sqlite3.Connection, table: str, column: str, ids: List[int]):
+    with conn:
+        conn.executemany(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", [(p,) for p in ids])
+
+def _delete_ids_by(conn: sqlite3.Connection, table: str, column: str, ids: List[int]):
+    with conn:
+        conn.executemany(f"DELETE FROM {table} WHERE {column}=?", [(p,) for p in ids])
+
+def _insert_ids(conn: sqlite3.Connection, table: str, ids: List[int]):
+    _insert_ids_by(conn, table, "id", ids)
+
+def _delete_ids(conn: sqlite3.Connection, table: str, ids: List[int]):
+    _delete_ids_by(conn, table, "id", ids)
+
+# マッチの状態遷移ごとに、変化した行だけを書く
+def _insert_match(conn: sqlite3.Connection, match_row: Tuple):
+    with conn:
+        conn.execute("""INSERT OR REPLACE INTO matches 
+            (match_id, guild_id, category_id, lobby_id, players, current_game, votes, is_dummy, schedule) 
+            VALUES (?,?,?,?,?,?,?,?,?)""", match_row)
+
+def _insert_game(conn: sqlite3.Connection, game_row: Tuple):
+    with conn:
+        conn.execute("""INSERT OR REPLACE INTO games (match_id, game_num, team_a, team_b, ch_a_id, ch_b_id)
+                        VALUES (?,?,?,?,?,?)""", game_row)
+        conn.execute("UPDATE matches SET current_game=? WHERE match_id=?", (game_row[1], game_row[0]))
+
+def _insert_vote(conn: sqlite3.Connection, match_id: int, game_num: int, user_id: int, vote: str):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO votes (match_id, game_num, user_id, vote) VALUES (?,?,?,?)",
+                     (match_id, game_num, user_id, vote))
+
+def _clear_votes(conn: sqlite3.Connection, match_id: int, game_num: int):
+    with conn:
+        conn.execute("DELETE FROM votes WHERE match_id=? AND game_num=?", (match_id, game_num))
+
+def _write_game_result(conn: sqlite3.Connection, match_id: int, game_num: int, winner: str,
+                       ratings_json: str, start_ratings_json: Optional[str]):
+    # _upsert_users のトランザクション内で呼ぶ（レート反映と勝敗の記録がずれないように）
+    conn.execute("UPDATE games SET winner=?, ratings=? WHERE match_id=? AND game_num=?",
+                 (winner, ratings_json, match_id, game_num))
+    if start_ratings_json is not None:
+        conn.execute("UPDATE matches SET start_ratings=? WHERE match_id=?", (start_ratings_json, match_id))
+    # 決着した試合の投票はもう使わない
+    conn.execute("DELETE FROM votes WHERE match_id=? AND game_num=?", (match_id, game_num))
+
+def _delete_match(conn: sqlite3.Connection, match_id: int):
+    with conn:
+        conn.execute("DELETE FROM matches WHERE match_id=?", (match_id,))
+        conn.execute("DELETE FROM games WHERE match_id=?", (match_id,))
+        conn.execute("DELETE FROM votes WHERE match_id=?", (match_id,))
+
+def _load_state(conn: sqlite3.Connection, dm_block_since: float) -> Dict[str, Any]:
+    # テーブルごとに1回ずつ読む（マッチ数が増えてもクエリ数は一定）
+    return {
+        "users": _select_users(conn),
+        "dm_blocked": _load_dm_blocked(conn, dm_block_since),
+        "waiting": conn.execute("SELECT id, seq FROM waiting_players ORDER BY seq ASC, id ASC").fetchall(),
+        "in_match": [row[0] for row in conn.execute("SELECT id FROM in_match_players")],
+        "lobby_pool": [row[0] for row in conn.execute("SELECT channel_id FROM lobby_pool")],
+        "matches": conn.execute("SELECT match_id, guild_id, category_id, lobby_id, players, current_game, votes, is_dummy, schedule, start_ratings FROM matches").fetchall(),
+        # idx_games_match の順に読めるのでソート不要
+        "games": conn.execute(
+            "SELECT match_id, game_num, team_a, team_b, ch_a_id, ch_b_id, winner, ratings FROM games ORDER BY match_id, game_num"
+        ).fetchall(),
+        "votes": conn.execute(
+            """SELECT v.match_id, v.user_id, v.vote FROM votes v
+               JOIN matches m ON m.match_id = v.match_id AND m.current_game = v.game_num""").fetchall(),
+    }
+
+def _insert_report(conn: sqlite3.Connection, reporter_id: int, target_id: int, reason: str, match_id: int):
+    with conn:
+        conn.execute(
+            "INSERT INTO reports (reporter_id, target_id, reason, match_id) VALUES (?,?,?,?)",
+            (reporter_id, target_id, reason, match_id)
+        )
+
+def _run_sql(conn: sqlite3.Connection, query: str) -> List[Tuple]:
+    # 書き込み用の共有接続なので、失敗やトランザクションの開きっぱなしを後に残さない
+    try:
+        cur = conn.execute(query)
+        rows = cur.fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if conn.in_transaction:
+        conn.rollback()
+        raise RuntimeError("トランザクションが閉じられていないため取り消しました")
+    return rows
+
+async def save_waiting_join(user_id: int, seq: int):
+    await db.run(_insert_waiting, user_id, seq)
+
+async def save_waiting_remove(user_ids: List[int]):
+    await db.run(_delete_ids, "waiting_players", list(user_ids))
+
+async def save_in_match_add(user_ids: List[int]):
+    await db.run(_insert_ids, "in_match_players", list(user_ids))
+
+async def save_in_match_remove(user_ids: List[int]):
+    await db.run(_delete_ids, "in_match_players", list(user_ids))
+
+async def save_match_created(match_id: int):
     m = current_matches[match_id]
-    cur.execute("""INSERT OR REPLACE INTO matches 
-        (match_id, guild_id, category_id, lobby_id, players, current_game, votes, is_dummy) 
-        VALUES (?,?,?,?,?,?,?,?)""",
-        (match_id, m["guild_id"], m["category_id"], m["lobby_id"],
-         serialize_players(m["players"]),
-         m["current_game"], json.dumps(list(m["votes"]), ensure_ascii=False), int(m["is_dummy"])))
-    cur.execute("DELETE FROM games WHERE match_id=?", (match_id,))
-    for g in m["games"]:
-        cur.execute("""INSERT INTO games (match_id, game_num, team_a, team_b, ch_a_id, ch_b_id)
-                       VALUES (?,?,?,?,?,?)""",
-                    (match_id, g["game_num"], json.dumps(g["team_a"], ensure_ascii=False),
-                     json.dumps(g["team_b"], ensure_ascii=False), g["ch_a_id"], g["ch_b_id"]))
-    conn.commit()
-
-def delete_match(match_id: int):
-    cur.execute("DELETE FROM matches WHERE match_id=?", (match_id,))
-    cur.execute("DELETE FROM games WHERE match_id=?", (match_id,))
-    conn.commit()
-
-def load_from_db():
-    # mu を user_data 表示用に読み込む
-    cur.execute("SELECT user_id, mu FROM users")
-    for uid, mu in cur.fetchall():
-        user_data[uid] = int(round(mu if mu is not None else DEFAULT_MU))
-    cur.execute("SELECT id FROM waiting_players")
-    waiting_players.extend([row[0] for row in cur.fetchall()])
-    cur.execute("SELECT id FROM in_match_players")
-    in_match_players.update([row[0] for row in cur.fetchall()])
-    cur.execute("SELECT match_id, guild_id, category_id, lobby_id, players, current_game, votes, is_dummy FROM matches")
-    for (match_id, guild_id, category_id, lobby_id, players_json, current_game, votes_json, is_dummy) in cur.fetchall():
+    await db.run(_insert_match, (
+        match_id, m["guild_id"], m["category_id"], m["lobby_id"],
+        serialize_players(m["players"]),
+        m["current_game"], json.dumps(list(m["votes"]), ensure_ascii=False), int(m["is_dummy"]),
+        json.dumps(m["schedule"]) if m.get("schedule") else None))
+
+async def save_game_created(match_id: int, g: Dict[str, Any]):
+    await db.run(_insert_game, (match_id, g["game_num"], json.dumps(g["team_a"], ensure_ascii=False),
+                                json.dumps(g["team_b"], ensure_ascii=False), g["ch_a_id"], g["ch_b_id"]))
+
+async def save_vote(match_id: int, game_num: int, user_id: int, vote: str):
+    await db.run(_insert_vote, match_id, game_num, user_id, vote)
+
+async def save_votes_cleared(match_id: int, game_num: int):
+    await db.run(_clear_votes, match_id, game_num)
+
+async def delete_match(match_id: int):
+    await db.run(_delete_match, match_id)
+
+async def load_from_db():
+    """起動時の一括復元。DB への往復は1回で、メモリ上の構造もここで1パスで組み立てる"""
+    global hydrated
+    t0 = time.perf_counter()
+    state = await db.run(_load_state, time.time() - DM_BLOCK_TTL)
+    # 全ユーザーのレートをメモリへ（user_data 表示用・順位インデックスもここで埋まる）
+    rating_store.load_rows(state["users"])
+    dm_outbox.blocked.update(state["dm_blocked"])
+    for uid, seq in state["waiting"]:
+        if uid not in waiting_players:
+            waiting_players.add(uid, get_user_trueskill(uid).mu, seq or 0)
+    in_match_players.update(state["in_match"])
+    lobby_pool.idle = [cid for cid in state["lobby_pool"] if cid not in lobby_pool.idle] + lobby_pool.idle
+    for (match_id, guild_id, category_id, lobby_id, players_json, current_game, votes_json, is_dummy,
+         schedule_json, start_ratings_json) in state["matches"]:
         mi = {
             "guild_id": guild_id,
             "category_id": category_id,
@@ -368,39 +1258,48 @@ def load_from_db():
             "games": [],
             "current_game": current_game,
             "votes": set(json.loads(votes_json) if votes_json else []),
-            "is_dummy": bool(is_dummy)
+            "is_dummy": bool(is_dummy),
+            "schedule": json.loads(schedule_json) if schedule_json else None,
+            "vote_results": {}
         }
-        cur.execute("SELECT game_num, team_a, team_b, ch_a_id, ch_b_id FROM games WHERE match_id=? ORDER BY game_num ASC", (match_id,))
-        for gnum, ta, tb, ca, cb in cur.fetchall():
-            mi["games"].append({
-                "game_num": gnum,
-                "team_a": json.loads(ta) if ta else [],
-                "team_b": json.loads(tb) if tb else [],
-                "ch_a_id": ca,
-                "ch_b_id": cb
-            })
+        if start_ratings_json:
+            mi["start_ratings"] = {int(uid): mu for uid, mu in json.loads(start_ratings_json).items()}
         current_matches[match_id] = mi
+    for match_id, gnum, ta, tb, ca, cb, winner, ratings_json in state["games"]:
+        mi = current_matches.get(match_id)
+        if mi is None:
+            continue
+        g = {
+            "game_num": gnum,
+            "team_a": json.loads(ta) if ta else [],
+            "team_b": json.loads(tb) if tb else [],
+            "ch_a_id": ca,
+            "ch_b_id": cb
+        }
+        if winner:
+            g["winner"] = winner
+            g["ratings"] = {int(uid): mu for uid, mu in json.loads(ratings_json or "{}").items()}
+            mi.setdefault("ratings", {}).update(g["ratings"])
+        mi["games"].append(g)
+        # 現在のチームは最後の試合の行から復元する（game_num 昇順なので最後に書いたものが残る）
+        mi["teams"] = {"A": g["team_a"], "B": g["team_b"]}
+    for match_id, user_id, vote in state["votes"]:
+        if match_id in current_matches:
+            current_matches[match_id]["vote_results"][user_id] = vote
+    print(f"DB 復元: {(time.perf_counter() - t0) * 1000:.1f}ms"
+          f"（ユーザー {len(state['users'])} / 待機 {len(waiting_players)} / マッチ {len(current_matches)}）")
+    hydrated = True
 
 def build_result_message(guild: discord.Guild, mi: dict, aborted: bool = False) -> discord.Embed:
-    """最終結果の順位表をEmbedで組み立てる"""
-    all_players = set()
-    for g in mi["games"]:
-        all_players.update(g["team_a"])
-        all_players.update(g["team_b"])
-    win_count = {uid: 0 for uid in all_players}
-
+    """最終結果の順位表をEmbedで組み立てる。
+    勝敗と更新後レートは apply_trueskill_updates 時に mi へ記録したものだけを使い、DB は読まない。"""
+    win_count: Dict[int, int] = {}
     for g in mi["games"]:
-        team_a = set(g["team_a"])
-        team_b = set(g["team_b"])
-        votes = g.get("vote_results", {})
-        a_score = sum(1 for uid, v in votes.items() if uid in team_a and v == "win")
-        b_score = sum(1 for uid, v in votes.items() if uid in team_b and v == "win")
-        if a_score > b_score:
-            for uid in team_a:
-                win_count[uid] += 1
-        elif b_score > a_score:
-            for uid in team_b:
-                win_count[uid] += 1
+        winner = g.get("winner")
+        for side, team in (("A", g["team_a"]), ("B", g["team_b"])):
+            for uid in team:
+                win_count[uid] = win_count.get(uid, 0) + (1 if winner == side else 0)
+    latest = mi.get("ratings", {})
 
     def name_of(uid: int) -> str:
         if uid < 0:
@@ -420,10 +1319,11 @@ def build_result_message(guild: discord.Guild, mi: dict, aborted: bool = False)
 
     for i, (uid, wins) in enumerate(ranking, start=1):
         old_mu = mi["start_ratings"].get(uid, DEFAULT_MU)
-        new_rating = get_user_trueskill(uid)
+        # 再起動などでスナップショットが無い場合もメモリ上のレートで補う
+        new_mu = latest.get(uid, rating_store.rows[uid][0] if uid in rating_store.rows else old_mu)
 
         old_disp = to_display(old_mu)
-        new_disp = to_display(new_rating.mu)
+        new_disp = to_display(new_mu)
 
         diff = new_disp - old_disp
         arrow = "🔹" if diff >= 0 else "🔸"
@@ -443,23 +1343,80 @@ def build_result_message(guild: discord.Guild, mi: dict, aborted: bool = False)
 
 
 # ========= 新: レート順マッチング関数 =========
-async def try_match_players_by_rating(guild: discord.Guild):
-    global waiting_players
-    if len(waiting_players) < PLAYERS_NEEDED:
-        return
-    players_with_rating = []
-    for uid in waiting_players:
-        ensure_user_row(uid)
-        r = get_user_trueskill(uid)
-        players_with_rating.append((uid, r.mu))
-    players_with_rating.sort(key=lambda x: x[1], reverse=True)
-    while len(players_with_rating) >= PLAYERS_NEEDED:
-        group_ids = [uid for uid, _ in players_with_rating[:PLAYERS_NEEDED]]
-        players_with_rating = players_with_rating[PLAYERS_NEEDED:]
-        waiting_players = [uid for uid in waiting_players if uid not in group_ids]
-        save_waiting_players()
+MATCHMAKING_DEBOUNCE = 0.15  # 参加が続いたときにまとめて1回で処理するための待ち時間（秒）
+
+matchmaking_wakeup = asyncio.Event()
+matchmaking_lock = asyncio.Lock()
+match_start_tasks: Set[asyncio.Task] = set()
+matchmaking_task: Optional[asyncio.Task] = None
+
+def request_matchmaking():
+    """待機リストの変化を通知する。実際の処理は matchmaking_worker がデバウンス後に行う"""
+    if len(waiting_players) >= PLAYERS_NEEDED:
+        matchmaking_wakeup.set()
+
+# マッチング1回あたりの処理時間（ロック待ちは含まない）
+matchmaking_stats = {"passes": 0, "seconds": 0.0, "max_seconds": 0.0}
+
+async def run_matchmaking_pass():
+    async with matchmaking_lock:
+        t0 = time.perf_counter()
+        try:
+            for guild in bot.guilds:
+                await try_match_players_by_rating(guild)
+        finally:
+            elapsed = time.perf_counter() - t0
+            matchmaking_stats["passes"] += 1
+            matchmaking_stats["seconds"] += elapsed
+            matchmaking_stats["max_seconds"] = max(matchmaking_stats["max_seconds"], elapsed)
+
+async def matchmaking_worker():
+    while True:
+        await matchmaking_wakeup.wait()
+        await asyncio.sleep(MATCHMAKING_DEBOUNCE)
+        matchmaking_wakeup.clear()
+        try:
+            await run_matchmaking_pass()
+        except Exception as e:
+            print(f"マッチング処理エラー: {e}")
+
+async def _start_matched_group(guild: discord.Guild, group_ids: List[int]):
+    match_id = None
+    try:
         group_members = [guild.get_member(uid) for uid in group_ids]
-        await start_match_core(guild, group_members, is_dummy_mode=False)
+        match_id = await start_match_core(guild, group_members, is_dummy_mode=False)
+    except Exception as e:
+        print(f"マッチ開始失敗: {group_ids} {e}")
+    if match_id is None:
+        # 開始できなかったグループは対戦中扱いを解除する
+        in_match_players.difference_update(group_ids)
+        tag = rest_match_tag.get()
+        if tag in current_matches:
+            # 登録後に失敗したマッチは途中まで作ったロビーごと片付ける
+            try:
+                await end_match(guild, tag)
+            except Exception as e:
+                print(f"開始失敗マッチの片付け失敗: {tag} {e}")
+        if tag is not None:
+            rest_scheduler.discard_match(tag)
+
+async def try_match_players_by_rating(guild: discord.Guild):
+    while len(waiting_players) >= PLAYERS_NEEDED:
+        # 待機中にサーバーを抜けた人は対戦中扱いにせず、待機リストから外して組み直す
+        left = [uid for uid in waiting_players.peek_top(PLAYERS_NEEDED) if guild.get_member(uid) is None]
+        if left:
+            for uid in left:
+                waiting_players.remove(uid)
+            await save_waiting_remove(left)
+            continue
+        group_ids = waiting_players.pop_top(PLAYERS_NEEDED)
+        # ロビー作成を待つ間に再エントリーされないよう、先に対戦中扱いにする
+        in_match_players.update(group_ids)
+        await save_waiting_remove(group_ids)
+        # ロビー作成などは並行して進め、次のグループの処理を待たせない
+        task = asyncio.create_task(_start_matched_group(guild, group_ids))
+        match_start_tasks.add(task)
+        task.add_done_callback(match_start_tasks.discard)
 
 # ==== 共通処理を関数に分離 ====
 async def handle_match_join(interaction: discord.Interaction):
@@ -486,8 +1443,9 @@ async def handle_match_join(interaction: discord.Interaction):
             await interaction.response.send_message("現在進行中のマッチに参加中です。", ephemeral=True)
             return
 
-    waiting_players.append(user_id)
-    save_waiting_players()
+    seq = waiting_players.add(user_id, get_user_trueskill(user_id).mu)
+    await save_waiting_join(user_id, seq)
+    request_matchmaking()
     await interaction.response.send_message(f"待機リストに参加しました",ephemeral=True)
 
 
@@ -508,17 +1466,21 @@ async def handle_match_leave(interaction: discord.Interaction):
         return
 
     waiting_players.remove(user_id)
-    save_waiting_players()
+    await save_waiting_remove([user_id])
     await interaction.response.send_message(
         f"待機リストから退出しました。",
         ephemeral=True
     )
 
 # ========= 定期チェックタスク =========
+# 通常は request_matchmaking で即時に処理される。こちらは取りこぼし用の定期スイープ
 @tasks.loop(seconds=MATCHMAKING_INTERVAL)
 async def matchmaking_loop():
-    for guild in bot.guilds:
-        await try_match_players_by_rating(guild)
+    await run_matchmaking_pass()
+
+@tasks.loop(seconds=RATING_FLUSH_INTERVAL)
+async def rating_flush_loop():
+    await rating_store.flush()
 
 @bot.event
 async def on_member_join(member: discord.Member):
@@ -526,8 +1488,30 @@ async def on_member_join(member: discord.Member):
     # category = guild.get_channel(1407518929026416831)  # 専用カテゴリ
     
     ensure_user_row(member.id)
+    member_name_index(guild).add(member)
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if before.display_name != after.display_name or before.name != after.name:
+        member_name_index(after.guild).add(after)
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    index = member_name_indexes.get(member.guild.id)
+    if index is not None:
+        index.remove(member.id)
+
+@bot.event
+async def on_user_update(before: discord.User, after: discord.User):
+    # ユーザー名・表示名の変更は on_member_update では届かないので、参加中の全サーバーの索引を直す
+    if before.name == after.name and before.global_name == after.global_name:
+        return
+    for guild_id, index in member_name_indexes.items():
+        guild = bot.get_guild(guild_id)
+        member = guild.get_member(after.id) if guild else None
+        if member is not None:
+            index.add(member)
 
-   
 
 # @bot.tree.command(name="r", description="指定ユーザー、または自分のレートを確認します")
 # async def str_command(interaction: discord.Interaction, target: str | None = None):
@@ -559,11 +1543,8 @@ async def on_member_join(member: discord.Member):
 #     display = to_display(r.mu)
 
 #     # 順位計算
-#     cur.execute("SELECT user_id, mu FROM users")
-#     all_users = cur.fetchall()
-#     sorted_users = sorted(all_users, key=lambda x: x[1], reverse=True)
-#     rank = next((i for i, (uid, _) in enumerate(sorted_users, start=1) if uid == member.id), None)
-#     total = len(sorted_users)
+#     rank = leaderboard.rank(member.id)
+#     total = len(leaderboard)
 
 #     msg = f"{member.display_name} | {display:.1f} | "
 #     if rank:
@@ -599,9 +1580,7 @@ async def on_member_join(member: discord.Member):
 #         await interaction.response.send_message("Botは指定できません。", ephemeral=True)
 #         return
 
-#     ensure_user_row(member.id)
-#     cur.execute("SELECT wins, games FROM users WHERE user_id=?", (member.id,))
-#     wins, games = cur.fetchone()
+#     wins, games = rating_store.win_stats(member.id)
 #     if not games or games == 0:
 #         msg = f"{member.display_name} さんはまだ試合データがありません。"
 #     else:
@@ -613,6 +1592,7 @@ async def on_member_join(member: discord.Member):
 import discord
 
 @bot.tree.command(name="s", description="指定ユーザー、または自分の成績を確認します")
+@timed("/s")
 async def status_command(interaction: discord.Interaction, target: str | None = None):
     guild = interaction.guild or bot.get_guild(GUILD_ID)
     if not guild:
@@ -642,16 +1622,11 @@ async def status_command(interaction: discord.Interaction, target: str | None =
     display = to_display(r.mu)
 
     # 順位計算
-    cur.execute("SELECT user_id, mu FROM users")
-    all_users = cur.fetchall()
-    sorted_users = sorted(all_users, key=lambda x: x[1], reverse=True)
-    rank = next((i for i, (uid, _) in enumerate(sorted_users, start=1) if uid == member.id), None)
-    total = len(sorted_users)
+    rank = leaderboard.rank(member.id)
+    total = len(leaderboard)
 
     # 勝率計算
-    ensure_user_row(member.id)
-    cur.execute("SELECT wins, games FROM users WHERE user_id=?", (member.id,))
-    wins, games = cur.fetchone()
+    wins, games = rating_store.win_stats(member.id)
     if not games or games == 0:
         wr_text = "試合データなし"
     else:
@@ -670,29 +1645,68 @@ async def status_command(interaction: discord.Interaction, target: str | None =
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+RANKING_PAGE_SIZE = 20
+
 class RankingView(View):
-    def __init__(self, pages: list[discord.Embed], user: discord.User,
-                 start: int, end: int, guild: discord.Guild):
+    """順位表を1ページずつ表示する。表示中の行 (user_id, mu) をカーソルとして持ち、
+    前後のページは順位インデックスからその都度取り出す（全員分の行や Embed は作らない）。"""
+    def __init__(self, user: discord.User, guild: discord.Guild, start: int = 1):
         super().__init__(timeout=None)  # ⬅ 無期限
-        self.pages = pages
-        self.current = 0
         self.user = user
-        self.start = start
-        self.end = end
         self.guild = guild
+        self.rows: List[Tuple[int, float]] = []
+        self.first_rank = 1
+        self.load_at(start)
+
+    def load_at(self, rank: int):
+        total = len(leaderboard)
+        self.first_rank = max(1, min(rank, total))
+        self.rows = leaderboard.page(self.first_rank, RANKING_PAGE_SIZE)
+        self.update_buttons()
+
+    def load_after(self):
+        # 最後の行より下を続きから取る（表示中にレートが動いても重複・欠落しない）
+        rows = leaderboard.page_after(self.rows[-1], RANKING_PAGE_SIZE) if self.rows else []
+        if rows:
+            self.rows = rows
+            self.first_rank = leaderboard.rank_of_row(rows[0])
+        self.update_buttons()
+
+    def load_before(self):
+        rows = leaderboard.page_before(self.rows[0], RANKING_PAGE_SIZE) if self.rows else []
+        if len(rows) < RANKING_PAGE_SIZE:
+            self.load_at(1)
+            return
+        self.rows = rows
+        self.first_rank = leaderboard.rank_of_row(rows[0])
         self.update_buttons()
 
+    def render(self) -> discord.Embed:
+        total = len(leaderboard)
+        last_rank = self.first_rank + len(self.rows) - 1
+        lines = []
+        for i, (uid, mu) in enumerate(self.rows, start=self.first_rank):
+            member = self.guild.get_member(uid)
+            name = member.display_name if member else f"Unknown({uid})"
+            lines.append(f"{i}位: {name} | {mu:.1f}")
+        embed = discord.Embed(
+            title=f"レート順位表 {self.first_rank}位〜{last_rank}位",
+            description="\n".join(lines) or "ユーザーデータがありません。",
+            color=discord.Color.gold()
+        )
+        embed.set_footer(text=f"ページ {(self.first_rank - 1) // RANKING_PAGE_SIZE + 1}/"
+                              f"{max(1, (total - 1) // RANKING_PAGE_SIZE + 1)} | 全{total}人中")
+        return embed
+
     def update_buttons(self):
+        at_top = self.first_rank <= 1
+        at_bottom = self.first_rank + len(self.rows) - 1 >= len(leaderboard)
         for child in self.children:
             if isinstance(child, Button):
-                if child.custom_id == "first":
-                    child.disabled = self.current == 0
-                elif child.custom_id == "prev":
-                    child.disabled = self.current == 0
-                elif child.custom_id == "next":
-                    child.disabled = self.current == len(self.pages) - 1
-                elif child.custom_id == "last":
-                    child.disabled = self.current == len(self.pages) - 1
+                if child.custom_id in ("first", "prev"):
+                    child.disabled = at_top
+                elif child.custom_id in ("next", "last"):
+                    child.disabled = at_bottom
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         # 実行者以外は操作不可
@@ -702,120 +1716,67 @@ class RankingView(View):
         return True
 
     @discord.ui.button(label="⏮", style=discord.ButtonStyle.secondary, custom_id="first")
+    @timed()
     async def first_page(self, interaction: discord.Interaction, button: Button):
-        self.current = 0
-        self.update_buttons()
-        await interaction.response.edit_message(embed=self.pages[self.current], view=self)
+        self.load_at(1)
+        await interaction.response.edit_message(embed=self.render(), view=self)
 
     @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary, custom_id="prev")
+    @timed()
     async def prev_page(self, interaction: discord.Interaction, button: Button):
-        self.current -= 1
-        self.update_buttons()
-        await interaction.response.edit_message(embed=self.pages[self.current], view=self)
+        self.load_before()
+        await interaction.response.edit_message(embed=self.render(), view=self)
 
     @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary, custom_id="next")
+    @timed()
     async def next_page(self, interaction: discord.Interaction, button: Button):
-        self.current += 1
-        self.update_buttons()
-        await interaction.response.edit_message(embed=self.pages[self.current], view=self)
+        self.load_after()
+        await interaction.response.edit_message(embed=self.render(), view=self)
 
     @discord.ui.button(label="⏭", style=discord.ButtonStyle.secondary, custom_id="last")
+    @timed()
     async def last_page(self, interaction: discord.Interaction, button: Button):
-        self.current = len(self.pages) - 1
-        self.update_buttons()
-        await interaction.response.edit_message(embed=self.pages[self.current], view=self)
+        total = len(leaderboard)
+        self.load_at((total - 1) // RANKING_PAGE_SIZE * RANKING_PAGE_SIZE + 1)
+        await interaction.response.edit_message(embed=self.render(), view=self)
 
     @discord.ui.button(label="🔄 更新", style=discord.ButtonStyle.primary, custom_id="refresh")
+    @timed()
     async def refresh(self, interaction: discord.Interaction, button: Button):
-        # DBから再取得して最新の順位表を作り直す
-        cur.execute("SELECT user_id, mu FROM users")
-        all_users = cur.fetchall()
-        sorted_users = sorted(all_users, key=lambda x: x[1], reverse=True)
-
-        total = len(sorted_users)
-        start = max(1, self.start)
-        end = min(total, self.end)
-
-        lines = []
-        for i in range(start, end + 1):
-            uid, mu = sorted_users[i - 1]
-            member = self.guild.get_member(uid)
-            name = member.display_name if member else f"Unknown({uid})"
-            lines.append(f"{i}位: {name} | {mu:.1f}")
-
-        PAGE_SIZE = 20
-        self.pages = []
-        for i in range(0, len(lines), PAGE_SIZE):
-            chunk = lines[i:i + PAGE_SIZE]
-            embed = discord.Embed(
-                title=f"レート順位表 {start}位〜{end}位",
-                description="\n".join(chunk),
-                color=discord.Color.gold()
-            )
-            embed.set_footer(text=f"ページ {len(self.pages)+1}/{(len(lines)-1)//PAGE_SIZE+1}")
-            self.pages.append(embed)
-
-        # ページ番号をリセットして再表示
-        self.current = 0
-        self.update_buttons()
-        await interaction.response.edit_message(embed=self.pages[self.current], view=self)
+        # 同じ順位の位置を最新のレートで表示し直す
+        self.load_at(self.first_rank)
+        await interaction.response.edit_message(embed=self.render(), view=self)
 
 
 # @bot.tree.command(name="r", description="レートの順位表を表示します")
+# @timed("/r")
 # async def ranking_command(
 #     interaction: discord.Interaction,
 #     start: int | None = None,   # 開始順位のみ
 # ):
-#     # DB から全ユーザー取得
-#     cur.execute("SELECT user_id, mu FROM users")
-#     all_users = cur.fetchall()
-#     if not all_users:
+#     total = len(leaderboard)
+#     if not total:
 #         await interaction.response.send_message("⚠️ ユーザーデータがありません。", ephemeral=True)
 #         return
 
-#     # ソート
-#     sorted_users = sorted(all_users, key=lambda x: x[1], reverse=True)
-#     total = len(sorted_users)
-
 #     # 開始順位の決定
-#     if start is None:
-#         start = 1
-#     start = max(1, start)
+#     start = max(1, start or 1)
 #     if start > total:
 #         await interaction.response.send_message("⚠️ 指定された開始順位は範囲外です。", ephemeral=True)
 #         return
 
-#     # ライン作成（startから最後まで）
-#     lines = []
-#     for i in range(start, total + 1):
-#         uid, mu = sorted_users[i - 1]
-#         member = interaction.guild.get_member(uid)
-#         name = member.display_name if member else f"Unknown({uid})"
-#         lines.append(f"{i}位: {name} | {mu:.1f}")
-
-#     # ページ分割
-#     PAGE_SIZE = 20
-#     pages = []
-#     for i in range(0, len(lines), PAGE_SIZE):
-#         chunk = lines[i:i + PAGE_SIZE]
-#         embed = discord.Embed(
-#             title=f"順位表 {start}位〜{total}位",
-#             description="\n".join(chunk),
-#             color=discord.Color.gold()
-#         )
-#         embed.set_footer(text=f"ページ {len(pages)+1}/{(len(lines)-1)//PAGE_SIZE+1} | 全{total}人中")
-#         pages.append(embed)
-
-#     # ページ切替ビューをセット
-#     view = RankingView(pages, interaction.user, start, total, interaction.guild)
-#     await interaction.response.send_message(embed=pages[0], view=view, ephemeral=True)
+#     # 表示するページだけを順位インデックスから取り出す
+#     view = RankingView(interaction.user, interaction.guild, start)
+#     await interaction.response.send_message(embed=view.render(), view=view, ephemeral=True)
 
 @bot.tree.command(name="c", description="マッチング待機リストに参加")
+@timed("/c")
 async def match_join(interaction: discord.Interaction):
     await handle_match_join(interaction)
 
 
 @bot.tree.command(name="match_random8", description="管理者用：サーバー内からランダムに8人選んでマッチ開始（テスト用）")
+@timed("/match_random8")
 async def match_random8(interaction: discord.Interaction):
     guild = interaction.guild or bot.get_guild(GUILD_ID)
     if not guild:
@@ -841,10 +1802,12 @@ async def match_random8(interaction: discord.Interaction):
 
 
 @bot.tree.command(name="l", description="マッチング待機リストから抜けます")
+@timed("/l")
 async def match_leave(interaction: discord.Interaction):
     await handle_match_leave(interaction)
 
 @bot.tree.command(name="sql", description="SQL を直接実行します（管理者専用）")
+@timed("/sql")
 async def sql_command(interaction: discord.Interaction, query: str):
     # 管理者チェック（必要に応じて権限を確認）
     if not interaction.user.guild_permissions.administrator:
@@ -852,14 +1815,13 @@ async def sql_command(interaction: discord.Interaction, query: str):
         return
 
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(query)
-
-        # 結果をフェッチ
-        rows = cur.fetchall()
-        conn.commit()
-        conn.close()
+        # メモリ上の未書き戻し分を先に反映し、実行後は users を読み直す
+        await rating_store.flush()
+        rows = await db.run(_run_sql, query)
+        await rating_store.load()
+        # 進行中でなくなったマッチの REST 回数は end_match を通らないのでここで捨てる
+        for match_id in set(rest_scheduler.match_calls) - set(current_matches):
+            rest_scheduler.discard_match(match_id)
 
         if rows:
             # 結果を文字列化（長すぎる場合はカット）
@@ -874,8 +1836,317 @@ async def sql_command(interaction: discord.Interaction, query: str):
     except Exception as e:
         await interaction.response.send_message(f"エラー: {e}", ephemeral=True)
 
+PERF_TOP_N = 15
+
+@bot.tree.command(name="perf", description="管理者用：内部のパフォーマンス統計を表示します")
+@timed("/perf")
+async def perf_command(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("管理者のみ使用可能です。", ephemeral=True)
+        return
+
+    st = db.stats()
+    lines = [
+        "**DB（書き込みスレッド）**",
+        f"実行数: {st['jobs']} / ループ外で処理した時間: {st['busy_seconds']:.3f}s / 最大: {st['max_job_ms']:.1f}ms",
+    ]
+    rs = rest_scheduler.stats()
+    lines += [
+        "**Discord REST**",
+        f"待ち: {rs['depth']} / 完了: {rs['completed']} / 失敗: {rs['failed']} / 統合: {rs['coalesced']}",
+        f"1マッチあたり（直近平均）: {rs['per_match_avg']:.1f} 回",
+        "**DM 送信箱**",
+        f"未配信: {await dm_outbox.pending()} / 送信済み: {dm_outbox.sent} / 再送: {dm_outbox.retried} / 失敗: {dm_outbox.failed} / 拒否キャッシュ: {len(dm_outbox.blocked)}",
+        f"**処理時間（合計の多い順 {PERF_TOP_N} 件: 回数 / p50 / p99 / 最大）**",
+    ]
+    for label, ring in sorted(latency.items(), key=lambda kv: kv[1].total, reverse=True)[:PERF_TOP_N]:
+        p50, p99 = ring.quantiles((0.5, 0.99))
+        lines.append(f"`{label}` {ring.count} / {p50 * 1000:.1f}ms / {p99 * 1000:.1f}ms / {ring.max * 1000:.1f}ms")
+    await interaction.response.send_message("\n".join(lines)[:2000], ephemeral=True)
+
+REPLAY_TOP_N = 10
+
+@bot.tree.command(name="replay", description="管理者用：試合台帳から全員のレートを再計算します")
+@timed("/replay")
+async def replay_command(interaction: discord.Interaction, apply: bool = False):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("管理者のみ使用可能です。", ephemeral=True)
+        return
+    if apply and current_matches:
+        await interaction.response.send_message("進行中のマッチがあるため反映できません（apply なしで試算のみ可能です）。", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    # 台帳に入っていない最新の試合があれば先に書き出す
+    await rating_store.flush()
+    result = await asyncio.to_thread(replay_ledger, db.path, ts)
+    replayed = result["ratings"]
+
+    changes = []
+    for uid, rating in replayed.items():
+        current_mu = rating_store.rows[uid][0] if uid in rating_store.rows else DEFAULT_MU
+        changes.append((rating.mu - current_mu, uid))
+    changes.sort(key=lambda x: abs(x[0]), reverse=True)
+    mean_abs = sum(abs(d) for d, _ in changes) / len(changes) if changes else 0.0
+
+    lines = [
+        f"試合 {result['games']} / 対象 {len(replayed)} 人（台帳以前の履歴から開始 {result['seeded']} 人）/ {result['seconds']:.2f}s",
+        f"現在のレートとの差（平均）: {to_display(DEFAULT_MU + mean_abs) - to_display(DEFAULT_MU):.1f}",
+    ]
+    for diff, uid in changes[:REPLAY_TOP_N]:
+        member = interaction.guild.get_member(uid) if interaction.guild else None
+        name = member.display_name if member else f"<@{uid}>"
+        old_mu = rating_store.rows[uid][0] if uid in rating_store.rows else DEFAULT_MU
+        lines.append(f"{name}: {to_display(old_mu):.1f} → {to_display(old_mu + diff):.1f}")
+
+    if apply and current_matches:
+        # 再計算の間に始まったマッチがあれば、その試合の反映と競合するので止める
+        lines.append("⚠️ 再計算中にマッチが始まったため反映しませんでした。")
+    elif apply:
+        # mu/sigma だけを置き換える（勝敗数は台帳以前の分も含むのでそのまま）
+        for uid, rating in replayed.items():
+            rating_store.set(uid, rating)
+        await rating_store.flush()
+        lines.append("✅ 再計算したレートを反映しました。")
+    await interaction.followup.send("\n".join(lines)[:2000], ephemeral=True)
+
+# ========= ロビーチャンネルプール =========
+LOBBY_POOL_NAME = "待機ロビー"
+LOBBY_POOL_MIN = 1          # 常に温めておく最小数
+LOBBY_POOL_MAX = 10
+LOBBY_POOL_WINDOW = 600     # この秒数内に始まったマッチ数をプールの目標数にする
+CHANNEL_RENAME_LIMIT = 2    # Discord はチャンネル名の変更を 10 分に 2 回までに制限している
+LOBBY_PURGE_LIMIT = 200     # 履歴削除の上限。これで消し切れないロビーはチャンネルごと削除する
+
+class LobbyPool:
+    """非表示のロビーチャンネルを使い回す。マッチ開始は権限の上書き1回で済み、
+    名前変更・履歴削除・補充はすべて background レーンで後から行う。"""
+    def __init__(self):
+        self.idle: List[int] = []
+        self.recycling: Set[int] = set()                # background レーンで片付け中（待ち含む）のロビー
+        self.starts: deque = deque()                    # 最近のマッチ開始時刻
+        self.renames: Dict[int, deque] = {}            # channel_id -> 名前変更時刻
+
+    def hidden_overwrites(self, guild: discord.Guild) -> Dict[Any, discord.PermissionOverwrite]:
+        return {guild.default_role: discord.PermissionOverwrite(read_messages=False)}
+
+    def target_size(self) -> int:
+        now = time.monotonic()
+        while self.starts and now - self.starts[0] > LOBBY_POOL_WINDOW:
+            self.starts.popleft()
+        return max(LOBBY_POOL_MIN, min(LOBBY_POOL_MAX, len(self.starts)))
+
+    async def acquire(self, guild: discord.Guild, category: discord.CategoryChannel,
+                      overwrites: Dict[Any, discord.PermissionOverwrite], name: str) -> discord.TextChannel:
+        self.starts.append(time.monotonic())
+        lobby = None
+        while self.idle and lobby is None:
+            cid = self.idle.pop()
+            await db.run(_delete_ids_by, "lobby_pool", "channel_id", [cid])
+            ch = guild.get_channel(cid)
+            if isinstance(ch, discord.TextChannel) and ch.category_id == category.id:
+                await rest_scheduler.run(LANE_MATCH, lambda: ch.edit(overwrites=overwrites))
+                lobby = ch
+                self._rename_later(ch, name)
+        if lobby is None:
+            lobby = await rest_scheduler.run(LANE_MATCH, lambda: guild.create_text_channel(
+                name=name, category=category, overwrites=overwrites))
+        self.replenish(guild, category)
+        return lobby
+
+    async def release(self, guild: discord.Guild, lobby: discord.TextChannel, thread_ids: List[int]):
+        """マッチ終了後のロビーを非表示に戻してプールへ返す（目標数を超えていれば削除）"""
+        for tid in thread_ids:
+            th = get_textlike(guild, tid)
+            if isinstance(th, discord.Thread):
+                rest_scheduler.fire(LANE_BACKGROUND, lambda th=th: delete_channel_safe(th), key=("delete", th.id))
+        if len(self.idle) + len(self.recycling) >= self.target_size():
+            rest_scheduler.fire(LANE_BACKGROUND, lambda: delete_channel_safe(lobby), key=("delete", lobby.id))
+            return
+        self.recycling.add(lobby.id)
+        rest_scheduler.fire(LANE_BACKGROUND, lambda: self._recycle(guild, lobby), key=("recycle", lobby.id))
+
+    async def _recycle(self, guild: discord.Guild, lobby: discord.TextChannel):
+        try:
+            await lobby.edit(overwrites=self.hidden_overwrites(guild))
+            deleted = await lobby.purge(limit=LOBBY_PURGE_LIMIT)
+            if len(deleted) >= LOBBY_PURGE_LIMIT:
+                # 履歴が多いロビーは消し切るまで background ワーカーを塞ぐので、作り直しに任せる
+                await delete_channel_safe(lobby)
+                return
+            self.idle.append(lobby.id)
+            await db.run(_insert_ids_by, "lobby_pool", "channel_id", [lobby.id])
+        finally:
+            self.recycling.discard(lobby.id)
+
+    def replenish(self, guild: discord.Guild, category: discord.CategoryChannel):
+        rest_scheduler.fire(LANE_BACKGROUND, lambda: self._replenish(guild, category), key=("lobby_pool", guild.id))
+
+    async def _replenish(self, guild: discord.Guild, category: discord.CategoryChannel):
+        while len(self.idle) + len(self.recycling) < self.target_size():
+            ch = await guild.create_text_channel(name=LOBBY_POOL_NAME, category=category,
+                                                 overwrites=self.hidden_overwrites(guild))
+            self.idle.append(ch.id)
+            await db.run(_insert_ids_by, "lobby_pool", "channel_id", [ch.id])
+
+    def _rename_later(self, ch: discord.TextChannel, name: str):
+        # 名前変更の上限に達している場合は変えずに使う（429 で background ワーカーを塞がないため）
+        now = time.monotonic()
+        history = self.renames.setdefault(ch.id, deque())
+        while history and now - history[0] > 600:
+            history.popleft()
+        if len(history) >= CHANNEL_RENAME_LIMIT:
+            return
+        history.append(now)
+        rest_scheduler.fire(LANE_BACKGROUND, lambda: ch.edit(name=name), key=("rename", ch.id))
+
+lobby_pool = LobbyPool()
+
+# ========= DM 送信箱 =========
+DM_CONCURRENCY = 2          # 同時に配信する DM の数
+DM_BATCH = 20               # 1回に取り出す件数
+DM_MAX_ATTEMPTS = 6
+DM_BACKOFF_BASE = 5         # 再送間隔（秒）: 5, 10, 20, ... 最大 DM_BACKOFF_MAX
+DM_BACKOFF_MAX = 600
+DM_BLOCK_TTL = 7 * 24 * 3600  # DM を拒否しているユーザーへの送信を止めておく期間（秒）
+DM_BLOCK_SWEEP_INTERVAL = 3600  # 期限切れの拒否記録を DB から消す間隔（秒）
+
+def _enqueue_dms(conn: sqlite3.Connection, rows: List[Tuple]):
+    with conn:
+        conn.executemany("INSERT INTO dm_outbox (user_id, payload, attempts, next_attempt) VALUES (?,?,0,?)", rows)
+
+def _due_dms(conn: sqlite3.Connection, now: float, limit: int) -> List[Tuple]:
+    return conn.execute(
+        "SELECT id, user_id, payload, attempts FROM dm_outbox WHERE next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+        (now, limit)).fetchall()
+
+def _next_dm_due(conn: sqlite3.Connection) -> Optional[float]:
+    return conn.execute("SELECT MIN(next_attempt) FROM dm_outbox").fetchone()[0]
+
+def _settle_dms(conn: sqlite3.Connection, done: List[int], retries: List[Tuple], blocked: List[Tuple]):
+    with conn:
+        conn.executemany("DELETE FROM dm_outbox WHERE id=?", [(i,) for i in done])
+        conn.executemany("UPDATE dm_outbox SET attempts=?, next_attempt=? WHERE id=?", retries)
+        conn.executemany("INSERT OR REPLACE INTO dm_blocked (user_id, blocked_at) VALUES (?,?)", blocked)
+
+def _load_dm_blocked(conn: sqlite3.Connection, since: float) -> List[Tuple[int, float]]:
+    return conn.execute("SELECT user_id, blocked_at FROM dm_blocked WHERE blocked_at >= ?", (since,)).fetchall()
+
+def _expire_dm_blocked(conn: sqlite3.Connection, since: float):
+    with conn:
+        conn.execute("DELETE FROM dm_blocked WHERE blocked_at < ?", (since,))
+
+def _count_dm_outbox(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT COUNT(*) FROM dm_outbox").fetchone()[0]
+
+class DMOutbox:
+    """結果 DM の永続送信箱。DB に積んでからワーカーが同時実行数を絞って配信し、
+    失敗は指数バックオフで再送する。DM を拒否（Forbidden）したユーザーは一定期間送らない。"""
+    def __init__(self):
+        self.blocked: Dict[int, float] = {}  # user_id -> 拒否された時刻（DB の dm_blocked と同じ）
+        self.swept = 0.0
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.failed = 0   # 再送を諦めた数
+        self.retried = 0  # 一時的な失敗で再送に回した数
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._worker())
+
+    async def enqueue(self, user_ids: List[int], embed: discord.Embed):
+        payload = json.dumps(embed.to_dict(), ensure_ascii=False)
+        now = time.time()
+        rows = [(uid, payload, now) for uid in user_ids if not self.is_blocked(uid, now)]
+        if rows:
+            await db.run(_enqueue_dms, rows)
+            self.wakeup.set()
+
+    def is_blocked(self, user_id: int, now: float) -> bool:
+        blocked_at = self.blocked.get(user_id)
+        if blocked_at is None:
+            return False
+        if now - blocked_at >= DM_BLOCK_TTL:
+            del self.blocked[user_id]  # 期限切れ（DM を許可し直したかもしれないので、また送ってみる）
+            return False
+        return True
+
+    async def expire_blocked(self):
+        """期限切れの拒否記録をメモリと DB から消す"""
+        now = time.time()
+        self.swept = now
+        for user_id in [u for u, at in self.blocked.items() if now - at >= DM_BLOCK_TTL]:
+            del self.blocked[user_id]
+        await db.run(_expire_dm_blocked, now - DM_BLOCK_TTL)
+
+    async def _worker(self):
+        while True:
+            try:
+                if time.time() - self.swept >= DM_BLOCK_SWEEP_INTERVAL:
+                    await self.expire_blocked()
+                rows = await db.run(_due_dms, time.time(), DM_BATCH)
+                if rows:
+                    await self._deliver(rows)
+                    continue
+                next_due = await db.run(_next_dm_due)
+                timeout = DM_BLOCK_SWEEP_INTERVAL
+                if next_due is not None:
+                    timeout = min(timeout, max(0.0, next_due - time.time()))
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                print(f"DM 送信箱エラー: {e}")
+                await asyncio.sleep(DM_BACKOFF_BASE)
+
+    async def _deliver(self, rows: List[Tuple]):
+        sem = asyncio.Semaphore(DM_CONCURRENCY)
+        done: List[int] = []
+        retries: List[Tuple] = []
+        blocked: List[Tuple] = []
+
+        async def send(row_id: int, user_id: int, payload: str, attempts: int):
+            if self.is_blocked(user_id, time.time()):
+                done.append(row_id)
+                return
+            async with sem:
+                try:
+                    user = bot.get_user(user_id) or await rest_scheduler.run(
+                        LANE_BACKGROUND, lambda: bot.fetch_user(user_id))
+                    embed = discord.Embed.from_dict(json.loads(payload))
+                    await rest_scheduler.run(LANE_BACKGROUND, lambda: user.send(embed=embed))
+                    done.append(row_id)
+                    self.sent += 1
+                except discord.Forbidden:
+                    now = time.time()
+                    self.blocked[user_id] = now
+                    blocked.append((user_id, now))
+                    done.append(row_id)
+                except (discord.NotFound, ValueError):
+                    done.append(row_id)  # 存在しないユーザー・壊れたデータは再送しない
+                except Exception as e:
+                    if attempts + 1 >= DM_MAX_ATTEMPTS:
+                        print(f"DM 送信を諦めました: {user_id} {e}")
+                        self.failed += 1
+                        done.append(row_id)
+                    else:
+                        self.retried += 1
+                        delay = min(DM_BACKOFF_BASE * 2 ** attempts, DM_BACKOFF_MAX)
+                        retries.append((attempts + 1, time.time() + delay, row_id))
+
+        await asyncio.gather(*(send(*row) for row in rows))
+        await db.run(_settle_dms, done, retries, blocked)
+
+    async def pending(self) -> int:
+        return await db.run(_count_dm_outbox)
+
+dm_outbox = DMOutbox()
+
 # ========= マッチ進行関連の関数 =========
-async def start_match_core(guild: discord.Guild, players: List[Any], is_dummy_mode: bool):
+async def start_match_core(guild: discord.Guild, players: List[Any], is_dummy_mode: bool) -> Optional[int]:
     parent_category = guild.get_channel(PARENT_CHANNEL_ID)
     if not isinstance(parent_category, discord.CategoryChannel):
         print(f"カテゴリが見つからないか、IDがカテゴリではありません: {PARENT_CHANNEL_ID}")
@@ -885,6 +2156,7 @@ async def start_match_core(guild: discord.Guild, players: List[Any], is_dummy_mo
     match_id = random.randint(1000, 9999)
     while match_id in current_matches:
         match_id = random.randint(1000, 9999)
+    rest_match_tag.set(match_id)
 
     # 権限設定
     overwrites = {guild.default_role: discord.PermissionOverwrite(read_messages=False)}
@@ -892,12 +2164,8 @@ async def start_match_core(guild: discord.Guild, players: List[Any], is_dummy_mo
     for m in real_players:
         overwrites[m] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
 
-    # ロビー作成
-    lobby = await guild.create_text_channel(
-        name=f"ロビー{match_id}",
-        category=parent_category,
-        overwrites=overwrites
-    )
+    # ロビー確保（プールに空きがあれば権限の上書きだけで済む）
+    lobby = await lobby_pool.acquire(guild, parent_category, overwrites, f"ロビー{match_id}")
 
     mentions, mus = [], []
     for p in players:
@@ -912,10 +2180,10 @@ async def start_match_core(guild: discord.Guild, players: List[Any], is_dummy_mo
                 mentions.append(m.mention+"\n")
                 mus.append(get_user_trueskill(p).mu)
 
-    await lobby.send(f"**マッチングしました！** \n参加者:\n👑{' '.join(mentions)}")
+    await rest_scheduler.run(LANE_MATCH, lambda: lobby.send(f"**マッチングしました！** \n参加者:\n👑{' '.join(mentions)}"))
     if mus:
         avg_mu = sum(mus) / len(mus)
-        await lobby.send(f"📊 このマッチの平均レート: **{to_display(avg_mu):.1f}**")
+        await rest_scheduler.run(LANE_MATCH, lambda: lobby.send(f"📊 このマッチの平均レート: **{to_display(avg_mu):.1f}**"))
 
     # === ホスト決定（待機リスト先頭 = players[0]） ===
     host_member = None
@@ -926,14 +2194,14 @@ async def start_match_core(guild: discord.Guild, players: List[Any], is_dummy_mo
         host_member = guild.get_member(first_player)
 
     if host_member:
-        await lobby.send(
+        await rest_scheduler.run(LANE_MATCH, lambda: lobby.send(
             f"ホストは {host_member.mention} さんです！\n"
             f"下のボタンからヘヤタテURLを入力してください。"
-        )
+        ))
         # ホスト専用ボタンを追加
         host_view = HostLinkView(host_member, lobby)
         bot.add_view(host_view)
-        await lobby.send(view=host_view)
+        await rest_scheduler.run(LANE_MATCH, lambda: lobby.send(view=host_view))
 
     # マッチ情報を保存
     current_matches[match_id] = {
@@ -944,28 +2212,52 @@ async def start_match_core(guild: discord.Guild, players: List[Any], is_dummy_mo
         "games": [],
         "current_game": 1,
         "votes": set(),
-        "is_dummy": is_dummy_mode
+        "is_dummy": is_dummy_mode,
+        "schedule": plan_team_schedule([rating_of_player(p) for p in players])
     }
 
     for m in real_players:
         in_match_players.add(m.id)
         ensure_user_row(m.id)
-    save_in_match_players()
+    await save_in_match_add([m.id for m in real_players])
+
+    await save_match_created(match_id)
 
     cancel_view = CancelMatchView(match_id)
     bot.add_view(cancel_view)
-    await lobby.send("⚠️ 対戦を中止する場合はこちら（5票で成立）", view=cancel_view)
+    await rest_scheduler.run(LANE_MATCH, lambda: lobby.send("⚠️ 対戦を中止する場合はこちら（5票で成立）", view=cancel_view))
 
     report_view = ReportButtonView(match_id)
     bot.add_view(report_view)
-    await lobby.send("🚨 プレイヤーを通報する場合はこちら", view=report_view)
+    await rest_scheduler.run(LANE_MATCH, lambda: lobby.send("🚨 プレイヤーを通報する場合はこちら", view=report_view))
 
     await create_and_announce_game(guild, match_id, game_num=1)
     await send_vote_buttons(guild, match_id, game_num=1, lobby_id=lobby.id)
-    save_match(match_id)
+    return match_id
 
 
 
+async def add_thread_members(thread: discord.Thread, members: List[discord.Member], label: str):
+    """スレッドへのメンバー追加を並行で行う。
+    レート制限は discord.py の HTTP クライアントがルートごとのバケット（X-RateLimit-Bucket）に
+    従って待機・再試行するため、固定の sleep は入れない。"""
+    async def add(m: discord.Member):
+        try:
+            await rest_scheduler.run(LANE_MATCH, lambda: thread.add_user(m))
+        except Exception as e:
+            print(f"{label}追加失敗: {m} {e}")
+
+    await asyncio.gather(*(add(m) for m in members))
+
+async def remove_thread_members(thread: discord.Thread, members: List[discord.Member]):
+    async def remove(m: discord.Member):
+        try:
+            await rest_scheduler.run(LANE_MATCH, lambda: thread.remove_user(m))
+        except Exception as e:
+            print(f"スレッド退出失敗: {m} {e}")
+
+    await asyncio.gather(*(remove(m) for m in members))
+
 async def create_and_announce_game(guild: discord.Guild, match_id: int, game_num: int):
     mi = current_matches.get(match_id)
     if not mi:
@@ -984,7 +2276,7 @@ async def create_and_announce_game(guild: discord.Guild, match_id: int, game_num
             return p
         return None
 
-    teams = get_preset_teams(mi["players"], game_num)
+    teams = get_preset_teams(mi["players"], game_num, mi.get("schedule"))
     team_a_list, team_b_list = teams["A"], teams["B"]
 
     team_a_members = real_members_only(guild, team_a_list)
@@ -1003,37 +2295,52 @@ async def create_and_announce_game(guild: discord.Guild, match_id: int, game_num
         return " ".join(res)
 
     # ✅ 先にチーム分けメッセージを送る
-    await lobby.send(
+    await rest_scheduler.run(LANE_MATCH, lambda: lobby.send(
         f"**試合 {game_num} 開始！**\n"
         f"チームA: {mentions_for(team_a_list)}\n"
         f"チームB: {mentions_for(team_b_list)}\n"
-    )
-
-    # その後でチームスレッドを作成
-    ch_a = await lobby.create_thread(
-        name=f"試合{game_num}-チームA",
-        type=discord.ChannelType.private_thread
-    )
-    ch_b = await lobby.create_thread(
-        name=f"試合{game_num}-チームB",
-        type=discord.ChannelType.private_thread
-    )
-
-    # チームAに招待
-    for m in team_a_members:
-        try:
-            await ch_a.add_user(m)
-            await asyncio.sleep(0.5)  # API連打回避
-        except Exception as e:
-            print(f"チームA追加失敗: {m} {e}")
-
-    # チームBに招待
-    for m in team_b_members:
-        try:
-            await ch_b.add_user(m)
-            await asyncio.sleep(0.5)
-        except Exception as e:
-            print(f"チームB追加失敗: {m} {e}")
+    ))
+
+    # チームスレッドはマッチ中ずっと使い回し、入れ替わった人だけ追加・削除する
+    prev_game = mi["games"][-1] if mi["games"] else None
+    ch_a = get_textlike(guild, prev_game["ch_a_id"]) if prev_game else None
+    ch_b = get_textlike(guild, prev_game["ch_b_id"]) if prev_game else None
+    if isinstance(ch_a, discord.Thread) and isinstance(ch_b, discord.Thread):
+        prev_a = set(prev_game["team_a"])
+        prev_b = set(prev_game["team_b"])
+        new_a = {m.id for m in team_a_members}
+        new_b = {m.id for m in team_b_members}
+        await asyncio.gather(
+            add_thread_members(ch_a, [m for m in team_a_members if m.id not in prev_a], "チームA"),
+            add_thread_members(ch_b, [m for m in team_b_members if m.id not in prev_b], "チームB"),
+            remove_thread_members(ch_a, real_members_only(guild, [u for u in prev_a if u not in new_a])),
+            remove_thread_members(ch_b, real_members_only(guild, [u for u in prev_b if u not in new_b])),
+        )
+    else:
+        # 初回（またはスレッドが消えていた場合）は A/B を並行して作る
+        created = await asyncio.gather(
+            rest_scheduler.run(LANE_MATCH, lambda: lobby.create_thread(
+                name="チームA",
+                type=discord.ChannelType.private_thread
+            )),
+            rest_scheduler.run(LANE_MATCH, lambda: lobby.create_thread(
+                name="チームB",
+                type=discord.ChannelType.private_thread
+            )),
+            return_exceptions=True,
+        )
+        errors = [r for r in created if isinstance(r, BaseException)]
+        if errors:
+            # 片方だけ作れた場合は取り残さないよう消してから失敗を伝える
+            for th in created:
+                if not isinstance(th, BaseException):
+                    rest_scheduler.fire(LANE_BACKGROUND, lambda th=th: delete_channel_safe(th), key=("delete", th.id))
+            raise errors[0]
+        ch_a, ch_b = created
+        await asyncio.gather(
+            add_thread_members(ch_a, team_a_members, "チームA"),
+            add_thread_members(ch_b, team_b_members, "チームB"),
+        )
 
     # DB用に保存
     mi["teams"] = {"A": [id_of(p) for p in team_a_list], "B": [id_of(p) for p in team_b_list]}
@@ -1045,26 +2352,20 @@ async def create_and_announce_game(guild: discord.Guild, match_id: int, game_num
         "ch_b_id": ch_b.id
     })
 
-    save_match(match_id)
+    await save_game_created(match_id, mi["games"][-1])
 
 
 
 
-async def cleanup_game_threads(guild: discord.Guild, match_id: int, game_num: int):
-    mi = current_matches.get(match_id)
-    if not mi:
-        return
-    for g in mi.get("games", []):
-        if g["game_num"] == game_num:
-            for key in ("ch_a_id", "ch_b_id"):
-                th = get_textlike(guild, g.get(key))
-                if isinstance(th, discord.Thread):
-                    try:
-                        await th.delete()
-                    except discord.Forbidden:
-                        pass
-
+async def delete_channel_safe(ch: Any):
+    try:
+        await ch.delete()
+    except (discord.Forbidden, discord.NotFound):
+        pass
 
+async def send_result_dms(user_ids: List[int], embed: discord.Embed):
+    """結果の DM を送信箱に積む（配信は dm_outbox のワーカーが行い、投票の処理はこれを待たない）"""
+    await dm_outbox.enqueue(user_ids, embed)
 
 async def send_vote_buttons(guild: discord.Guild, match_id: int, game_num: int, lobby_id: int):
     lobby = get_textlike(guild, lobby_id)
@@ -1072,29 +2373,29 @@ async def send_vote_buttons(guild: discord.Guild, match_id: int, game_num: int,
         return
     view = ResultButtonView(match_id=match_id, game_num=game_num)
     bot.add_view(view)  # Persistent View
-    await lobby.send(f"**試合 {game_num} の結果を登録してください**（8人中{VOTE_THRESHOLD}票で次へ）", view=view)
+    await rest_scheduler.run(LANE_MATCH, lambda: lobby.send(
+        f"**試合 {game_num} の結果を登録してください**（8人中{VOTE_THRESHOLD}票で次へ）", view=view))
 
 async def end_match(guild: discord.Guild, match_id: int):
     mi = current_matches.get(match_id)
     if not mi:
         return
 
-    # ロビー削除（配下のチームスレッドも自動削除される）
+    # ロビーはプールへ返却（チームスレッドは削除し、履歴は後から消す）
     lobby = guild.get_channel(mi.get("lobby_id"))
     if isinstance(lobby, discord.TextChannel):
-        try:
-            await lobby.delete()
-        except discord.Forbidden:
-            pass
+        thread_ids = list(dict.fromkeys(g[key] for g in mi.get("games", []) for key in ("ch_a_id", "ch_b_id") if g.get(key)))
+        await lobby_pool.release(guild, lobby, thread_ids)
 
     # 参加解除
-    for m in real_members_only(guild, mi["players"]):
-        in_match_players.discard(m.id)
-    save_in_match_players()
+    # マッチ中にサーバーを抜けた人も含め、対戦中扱いにした id をそのまま解除する
+    released = _collect_real_ids([p.id if isinstance(p, discord.Member) else p for p in mi["players"]])
+    in_match_players.difference_update(released)
+    await save_in_match_remove(released)
 
     current_matches.pop(match_id, None)
-    delete_match(match_id)
-    print(f"マッチ {match_id} を終了しました。")
+    await delete_match(match_id)
+    print(f"マッチ {match_id} を終了しました。（REST 操作 {rest_scheduler.finish_match(match_id)} 回）")
 
 
 
@@ -1103,45 +2404,138 @@ async def end_match(guild: discord.Guild, match_id: int):
 def _collect_real_ids(ids: List[int]) -> List[int]:
     return [uid for uid in ids if isinstance(uid, int) and uid > 0]
 
+# 2チーム・順位2つだけの試合では因子グラフの反復は1回で収束するので、更新式を直接計算する。
+#   σ'² = σ² + τ²,  c² = n·β² + Σσ'²,  t = (μ勝 − μ負) / c,  ε = draw_margin / c
+#   μ ± σ'²/c · v(t, ε),  σ² = σ'² · (1 − σ'²/c² · w(t, ε))
+# v, w と draw_margin は ts 環境のものをそのまま使うので、ts.rate と同じ値になる。
+@functools.lru_cache(maxsize=None)
+def _draw_margin(env: trueskill.TrueSkill, size: int) -> float:
+    return trueskill.calc_draw_margin(env.draw_probability, size, env=env)
+
+def rate_two_teams(team_a: List[trueskill.Rating], team_b: List[trueskill.Rating],
+                   outcome: str, env: trueskill.TrueSkill = ts) -> Tuple[List[trueskill.Rating], List[trueskill.Rating]]:
+    """outcome は "A" / "B" / "draw"。env.rate([team_a, team_b], ranks=...) と同じ結果を返す"""
+    if not team_a or not team_b:
+        raise ValueError("各チームに1人以上必要です")
+    tau2 = env.tau ** 2
+    var_a = [r.sigma ** 2 + tau2 for r in team_a]
+    var_b = [r.sigma ** 2 + tau2 for r in team_b]
+    n = len(team_a) + len(team_b)
+    c2 = n * env.beta ** 2 + sum(var_a) + sum(var_b)
+    c = math.sqrt(c2)
+    eps = _draw_margin(env, n) / c
+    diff = (sum(r.mu for r in team_a) - sum(r.mu for r in team_b)) / c
+    if outcome == "draw":
+        v, w = env.v_draw(diff, eps), env.w_draw(diff, eps)
+    else:
+        # 勝者側から見た差で計算し、A の更新方向（sign）に戻す
+        sign = 1.0 if outcome == "A" else -1.0
+        v, w = sign * env.v_win(sign * diff, eps), env.w_win(sign * diff, eps)
+
+    def update(team, variances, direction):
+        return [env.create_rating(r.mu + direction * var / c * v,
+                                 math.sqrt(var * (1 - var / c2 * w)))
+                for r, var in zip(team, variances)]
+
+    return update(team_a, var_a, 1.0), update(team_b, var_b, -1.0)
+
 async def apply_trueskill_updates(
     guild: discord.Guild,
     lobby_id: int,
     team_a_ids: List[int],
     team_b_ids: List[int],
     outcome: str,
-    start_mus: Dict[int, float]
-):
+    start_mus: Dict[int, float],
+    match_id: Optional[int] = None,
+    game_num: Optional[int] = None,
+    new_start_ratings: Optional[Dict[int, float]] = None
+) -> Dict[int, trueskill.Rating]:
     ratings_a = [get_user_trueskill(uid) for uid in team_a_ids]
     ratings_b = [get_user_trueskill(uid) for uid in team_b_ids]
 
-    if outcome == "A":
-        new_a, new_b = ts.rate([ratings_a, ratings_b], ranks=[0, 1])
-    elif outcome == "B":
-        new_a, new_b = ts.rate([ratings_a, ratings_b], ranks=[1, 0])
-    else:
-        new_a, new_b = ts.rate([ratings_a, ratings_b], ranks=[0, 0])
-
-    for uid, r in zip(team_a_ids, new_a):
-        set_user_trueskill(uid, r)
-    for uid, r in zip(team_b_ids, new_b):
-        set_user_trueskill(uid, r)
+    new_a, new_b = rate_two_teams(ratings_a, ratings_b, outcome)
+
+    # レート・試合数・勝利数を1トランザクションでまとめて確定
+    winners = set(team_a_ids) if outcome == "A" else (set(team_b_ids) if outcome == "B" else set())
+    updates = dict(zip(team_a_ids, new_a))
+    updates.update(zip(team_b_ids, new_b))
+    pre = {uid: [r.mu, r.sigma] for uid, r in zip(team_a_ids + team_b_ids, ratings_a + ratings_b)}
+    post = {uid: [r.mu, r.sigma] for uid, r in updates.items()}
+    ledger_row = (match_id, game_num, time.time(), json.dumps(team_a_ids), json.dumps(team_b_ids),
+                  outcome, json.dumps(pre), json.dumps(post))
+    # games の勝敗（と初回のマッチ開始時レート）も同じトランザクションで書く
+    game_result = None
+    if match_id is not None:
+        game_result = (match_id, game_num, outcome, json.dumps({uid: r.mu for uid, r in updates.items()}),
+                       json.dumps(new_start_ratings) if new_start_ratings is not None else None)
+    await rating_store.apply_game(updates, winners, ledger_row, game_result)
 
     lobby = get_textlike(guild, lobby_id)
     if is_textlike_channel(lobby):
         # （必要ならここで結果一覧を lobby.send できます）
         pass
 
-    # DB更新（既存処理のまま）
-    for uid in team_a_ids + team_b_ids:
-        cur.execute("UPDATE users SET games = COALESCE(games, 0) + 1 WHERE user_id=?", (uid,))
-    if outcome == "A":
-        for uid in team_a_ids:
-            cur.execute("UPDATE users SET wins = COALESCE(wins, 0) + 1 WHERE user_id=?", (uid,))
-    elif outcome == "B":
-        for uid in team_b_ids:
-            cur.execute("UPDATE users SET wins = COALESCE(wins, 0) + 1 WHERE user_id=?", (uid,))
-    conn.commit()
+    return updates
+
 
+# ========= 試合台帳からの再計算 =========
+LEDGER_REPLAY_PAGE = 5000
+
+def _ledger_pages(conn: sqlite3.Connection, columns: str):
+    """game_ledger を id 順にページ単位で読み、(id, *columns) の行を返す"""
+    last_id = 0
+    while True:
+        rows = conn.execute(f"SELECT id, {columns} FROM game_ledger WHERE id > ? ORDER BY id LIMIT ?",
+                            (last_id, LEDGER_REPLAY_PAGE)).fetchall()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1][0]
+
+def replay_ledger(path: str, env: trueskill.TrueSkill = ts) -> Dict[str, Any]:
+    """game_ledger を id 順（記録順）に読み、全員を順に再計算する。
+    開始レートは原則 env.create_rating()（sweep.py と同じ）。ただし users.games が台帳に載っている試合数より多い
+    ユーザー（台帳ができる前の試合がある）だけは、台帳に最初に現れた試合の pre から始めて、それ以前の分を保つ。
+    書き込みスレッドとは別の読み取り専用接続でページ単位に読むので、実行中も記録は止まらない（WAL）。"""
+    conn = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri=True)
+    ratings: Dict[int, trueskill.Rating] = {}
+    last_id = 0
+    games = 0
+    t0 = time.perf_counter()
+    try:
+        conn.execute("BEGIN")  # users と台帳を同じ時点のスナップショットで読む
+        played = dict(conn.execute("SELECT user_id, games FROM users").fetchall())
+        # 1パス目: 台帳に載っている試合数（これより多く試合をしている人は台帳以前の履歴がある）
+        in_ledger: Dict[int, int] = {}
+        for _, team_a_json, team_b_json in _ledger_pages(conn, "team_a, team_b"):
+            team_a, team_b = json.loads(team_a_json), json.loads(team_b_json)
+            if team_a and team_b:
+                for uid in team_a + team_b:
+                    in_ledger[uid] = in_ledger.get(uid, 0) + 1
+        seeded = {uid for uid, n in in_ledger.items() if (played.get(uid) or 0) > n}
+
+        for last_id, team_a_json, team_b_json, winner, pre_json in _ledger_pages(conn, "team_a, team_b, winner, pre"):
+            team_a, team_b = json.loads(team_a_json), json.loads(team_b_json)
+            if not team_a or not team_b:
+                continue
+            pre = json.loads(pre_json) if pre_json else {}
+            for uid in team_a + team_b:
+                if uid in ratings:
+                    continue
+                if uid in seeded and str(uid) in pre:
+                    mu, sigma = pre[str(uid)]
+                    ratings[uid] = env.create_rating(mu=mu, sigma=sigma)
+                else:
+                    ratings[uid] = env.create_rating()
+            new_a, new_b = rate_two_teams([ratings[uid] for uid in team_a], [ratings[uid] for uid in team_b],
+                                          winner, env)
+            ratings.update(zip(team_a, new_a))
+            ratings.update(zip(team_b, new_b))
+            games += 1
+    finally:
+        conn.close()
+    return {"games": games, "last_id": last_id, "ratings": ratings, "seeded": len(seeded),
+            "seconds": time.perf_counter() - t0}
 
 # ========= ボタン View =========
 class ResultButtonView(discord.ui.View):
@@ -1159,6 +2553,7 @@ class ResultButtonView(discord.ui.View):
     def _custom_id(self, kind: str) -> str:
         return f"match:{self.match_id}:game:{self.game_num}:{kind}"
 
+    @timed()
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         cid = interaction.data.get("custom_id", "")
         if cid.endswith(":win"):
@@ -1170,6 +2565,7 @@ class ResultButtonView(discord.ui.View):
         return False
 
     async def _handle_vote(self, interaction: discord.Interaction, result: str):
+        rest_match_tag.set(self.match_id)
         mi = current_matches.get(self.match_id)
         if not mi:
             await interaction.response.send_message("このマッチは存在しません。", ephemeral=True)
@@ -1201,70 +2597,85 @@ class ResultButtonView(discord.ui.View):
         await interaction.response.send_message(
             f"投票を受け付けました（{len(mi['vote_results'])}/{VOTE_THRESHOLD}）", ephemeral=True
         )
-        save_match(self.match_id)
+        await save_vote(self.match_id, self.game_num, interaction.user.id, result.lower())
 
         if len(mi["vote_results"]) >= VOTE_THRESHOLD:
-            winner = self._determine_winner(mi)
-            game_index = self.game_num - 1
-            mi["games"][game_index]["vote_results"] = dict(mi["vote_results"])
+            # 確定処理中に届いた票では何もしない（await の間に閾値を超える票が続けて来るため）
+            if mi.get("deciding") == self.game_num:
+                return
+            mi["deciding"] = self.game_num
+            try:
+                await self._decide_game(interaction, mi)
+            finally:
+                mi.pop("deciding", None)
+
+    async def _decide_game(self, interaction: discord.Interaction, mi: Dict[str, Any]):
+        game = mi["games"][self.game_num - 1]
+        guild = interaction.guild
+        lobby = get_textlike(guild, mi["lobby_id"])
 
-            guild = interaction.guild
-            lobby = get_textlike(guild, mi["lobby_id"])
+        # 勝敗とレートが記録済みの試合（次の試合の準備前に再起動した場合）は、レートを反映し直さず進行だけ再開する
+        if "winner" not in game:
+            winner = self._determine_winner(mi)
+            game["vote_results"] = dict(mi["vote_results"])
 
             if winner == "retry":
                 mi["vote_results"].clear()
-                save_match(self.match_id)
+                await save_votes_cleared(self.match_id, self.game_num)
                 if is_textlike_channel(lobby):
-                    await lobby.send(f"⚠️ 投票結果が不一致です。試合 {self.game_num} を再投票します。")
+                    await rest_scheduler.run(LANE_INTERACTION, lambda: lobby.send(
+                        f"⚠️ 投票結果が不一致です。試合 {self.game_num} を再投票します。"))
                 return
 
             if is_textlike_channel(lobby):
-                await lobby.send(f"**試合 {self.game_num} の結果: チーム {winner} 勝利！**")
+                await rest_scheduler.run(LANE_INTERACTION, lambda: lobby.send(
+                    f"**試合 {self.game_num} の結果: チーム {winner} 勝利！**"))
 
             team_b_ids = _collect_real_ids(mi["teams"]["B"])
             team_a_ids = _collect_real_ids(mi["teams"]["A"])
+            new_start_ratings = None
             if "start_ratings" not in mi:
-                start_ratings = {}
-                for uid in set(team_a_ids + team_b_ids):
-                    start_ratings[uid] = get_user_trueskill(uid).mu
-                mi["start_ratings"] = start_ratings
+                new_start_ratings = {uid: get_user_trueskill(uid).mu for uid in set(team_a_ids + team_b_ids)}
 
-            await apply_trueskill_updates(
+            post_ratings = await apply_trueskill_updates(
                 guild,
                 mi["lobby_id"],
                 team_a_ids,
                 team_b_ids,
                 "A" if winner == "A" else ("B" if winner == "B" else "draw"),
-                mi["start_ratings"]
+                mi.get("start_ratings") or new_start_ratings,
+                match_id=self.match_id,
+                game_num=self.game_num,
+                new_start_ratings=new_start_ratings
             )
-
-            # ← ここで直前のチームスレッドを掃除
-            await cleanup_game_threads(guild, self.match_id, self.game_num)
-
-            if mi["current_game"] < TOTAL_GAMES:
-                mi["current_game"] += 1
-                mi["vote_results"].clear()
+            # 反映できてから確定扱いにする（失敗したら再投票でやり直せる）
+            if new_start_ratings is not None:
+                mi["start_ratings"] = new_start_ratings
+            # 結果表示用のスナップショット（試合ごとの勝者と更新後レート）
+            game["winner"] = winner
+            game["ratings"] = {uid: r.mu for uid, r in post_ratings.items()}
+            mi.setdefault("ratings", {}).update(game["ratings"])
+
+        if mi["current_game"] < TOTAL_GAMES:
+            mi["current_game"] += 1
+            mi["vote_results"].clear()
+            try:
                 await create_and_announce_game(guild, self.match_id, game_num=mi["current_game"])
-                await send_vote_buttons(guild, self.match_id, game_num=mi["current_game"], lobby_id=mi["lobby_id"])
-                save_match(self.match_id)
-            else:
-                final_text = build_result_message(guild, mi, aborted=False)
-
-                if is_textlike_channel(lobby):
-                    await lobby.send(embed=final_text)
-                    await lobby.send("**全試合終了！お疲れさまでした！**")
-
-                for uid in [u for u in mi["start_ratings"].keys() if u > 0]:
-                    member = guild.get_member(uid)
-                    if member and not member.bot:
-                        try:
-                            await member.send(embed=final_text)
-                        except discord.Forbidden:
-                            pass
+            except Exception:
+                # 次の試合を用意できなければ確定済みの試合に戻す（再投票で準備からやり直せる）
+                mi["current_game"] -= 1
+                raise
+            await send_vote_buttons(guild, self.match_id, game_num=mi["current_game"], lobby_id=mi["lobby_id"])
+        else:
+            final_text = build_result_message(guild, mi, aborted=False)
 
-                await end_match(guild, self.match_id)
+            if is_textlike_channel(lobby):
+                await rest_scheduler.run(LANE_MATCH, lambda: lobby.send(embed=final_text))
+                await rest_scheduler.run(LANE_MATCH, lambda: lobby.send("**全試合終了！お疲れさまでした！**"))
 
+            await send_result_dms([u for u in mi["start_ratings"].keys() if u > 0], final_text)
 
+            await end_match(guild, self.match_id)
 
     def _determine_winner(self, mi):
         votes = mi["vote_results"]
@@ -1311,6 +2722,7 @@ class CancelMatchView(discord.ui.View):
         self.add_item(discord.ui.Button(label="⚠️ 対戦中止", style=discord.ButtonStyle.danger,
                                         custom_id=f"match:{match_id}:cancel"))
 
+    @timed()
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         mi = current_matches.get(self.match_id)
         if not mi:
@@ -1330,22 +2742,17 @@ class CancelMatchView(discord.ui.View):
         )
 
         if len(mi["cancel_votes"]) >= VOTE_THRESHOLD:
+            rest_match_tag.set(self.match_id)
             guild = interaction.guild
             lobby = get_textlike(guild, mi["lobby_id"])
             if is_textlike_channel(lobby):
-                await lobby.send("⚠️ **対戦が中止されました**")
+                await rest_scheduler.run(LANE_INTERACTION, lambda: lobby.send("⚠️ **対戦が中止されました**"))
 
             if "start_ratings" in mi:
                 final_text = build_result_message(guild, mi, aborted=True)
                 if is_textlike_channel(lobby):
-                    await lobby.send(embed=final_text)
-                for uid in [u for u in mi["start_ratings"].keys() if u > 0]:
-                    member = guild.get_member(uid)
-                    if member and not member.bot:
-                        try:
-                            await member.send(embed=final_text)
-                        except discord.Forbidden:
-                            pass
+                    await rest_scheduler.run(LANE_MATCH, lambda: lobby.send(embed=final_text))
+                await send_result_dms([u for u in mi["start_ratings"].keys() if u > 0], final_text)
 
             await end_match(guild, self.match_id)
 
@@ -1366,13 +2773,10 @@ class ReportReasonSelect(discord.ui.Select):
         ]
         super().__init__(placeholder="通報理由を選択してください", options=options, min_values=1, max_values=1)
 
+    @timed()
     async def callback(self, interaction: discord.Interaction):
         reason = self.values[0]
-        cur.execute(
-            "INSERT INTO reports (reporter_id, target_id, reason, match_id) VALUES (?,?,?,?)",
-            (self.reporter.id, self.target.id, reason, self.match_id)
-        )
-        conn.commit()
+        await db.run(_insert_report, self.reporter.id, self.target.id, reason, self.match_id)
 
         await interaction.response.send_message(
             f"✅ {self.target.mention} を通報しました（理由: {reason}）", ephemeral=True
@@ -1383,13 +2787,13 @@ class ReportReasonSelect(discord.ui.Select):
         if log_ch:
             reporter_name = self.reporter.display_name
             target_name = self.target.display_name
-            await log_ch.send(
+            rest_scheduler.fire(LANE_BACKGROUND, lambda: log_ch.send(
                 f"🚨 **通報ログ**\n"
                 f"試合ID: {self.match_id}\n"
                 f"通報者: {reporter_name} ({self.reporter.id})\n"
                 f"対象: {target_name} ({self.target.id})\n"
                 f"理由: {reason}"
-            )
+            ))
 class HostLinkModal(discord.ui.Modal, title="ヘヤタテURL入力"):
     link = discord.ui.TextInput(
         label="ヘヤタテURL",
@@ -1402,10 +2806,11 @@ class HostLinkModal(discord.ui.Modal, title="ヘヤタテURL入力"):
         self.host = host
         self.lobby_channel = lobby_channel
 
+    @timed()
     async def on_submit(self, interaction: discord.Interaction):
-        await self.lobby_channel.send(
+        await rest_scheduler.run(LANE_INTERACTION, lambda: self.lobby_channel.send(
             f"🔗 {self.host.mention} さんが共有したヘヤタテURL: **{self.link.value}**"
-        )
+        ))
         await interaction.response.send_message("✅ URLを登録しました！", ephemeral=True)
 
 
@@ -1416,6 +2821,7 @@ class HostLinkView(discord.ui.View):
         self.lobby_channel = lobby_channel
 
     @discord.ui.button(label="URLを入力する", style=discord.ButtonStyle.primary, custom_id="host_link")
+    @timed()
     async def host_link_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.host.id:
             await interaction.response.send_message("⚠️ あなたはホストではありません。", ephemeral=True)
@@ -1429,6 +2835,7 @@ class ReportButtonView(discord.ui.View):
         self.add_item(discord.ui.Button(label="🚨 通報", style=discord.ButtonStyle.secondary,
                                         custom_id=f"match:{match_id}:report"))
 
+    @timed()
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         mi = current_matches.get(self.match_id)
         if not mi:
@@ -1451,6 +2858,7 @@ class ReportButtonView(discord.ui.View):
         # ドロップダウンで対象を選ばせる
         select = discord.ui.Select(placeholder="通報対象を選んでください", options=options, min_values=1, max_values=1)
 
+        @timed("ReportButtonView.select_callback")
         async def select_callback(inter: discord.Interaction):
             target_id = int(select.values[0])
             target = inter.guild.get_member(target_id)
@@ -1479,6 +2887,7 @@ class MatchControlView(discord.ui.View):
         style=discord.ButtonStyle.primary,
         custom_id="match_join"
     )
+    @timed()
     async def join_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         await handle_match_join(interaction)
 
@@ -1487,15 +2896,126 @@ class MatchControlView(discord.ui.View):
         style=discord.ButtonStyle.danger,
         custom_id="match_leave"
     )
+    @timed()
     async def leave_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         await handle_match_leave(interaction)
 
 
 
+# ========= ヘルスチェック・メトリクス =========
+# bot と同じイベントループ上で動く HTTP サーバー。
+#   /healthz（/ も同じ）: プロセスとイベントループが応答しているか
+#   /readyz : ゲートウェイ接続済みで、DB からの復元も終わっているか
+#   /metrics: Prometheus のテキスト形式
+LOOP_LAG_INTERVAL = 0.5
+METRIC_QUANTILES = (0.5, 0.9, 0.99)
+
+hydrated = False            # load_from_db 完了
+gateway_connected = False   # on_connect/on_resumed で True、on_disconnect で False
+loop_lag = {"last": 0.0, "max": 0.0}
+health_runner: Optional[web.AppRunner] = None
+loop_lag_task: Optional[asyncio.Task] = None
+
+async def loop_lag_monitor():
+    """一定間隔で sleep し、予定より遅れて起きた分をイベントループの遅延として記録する"""
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - t0 - LOOP_LAG_INTERVAL)
+        loop_lag["last"] = lag
+        loop_lag["max"] = max(loop_lag["max"], lag)
+
+def is_bot_ready() -> bool:
+    return hydrated and gateway_connected and bot.is_ready() and not bot.is_closed()
+
+def render_metrics() -> str:
+    out: List[str] = []
+
+    def metric(name: str, kind: str, help_text: str, samples: List[Tuple[Dict[str, str], float]]):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            out.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+    metric("matchbot_ready", "gauge", "受付可能なら 1", [({}, int(is_bot_ready()))])
+    metric("matchbot_waiting_players", "gauge", "待機中の人数", [({}, len(waiting_players))])
+    metric("matchbot_active_matches", "gauge", "進行中のマッチ数", [({}, len(current_matches))])
+    metric("matchbot_matchmaking_pass_seconds", "summary", "マッチング1回の処理時間",
+           [({"quantile": "1"}, matchmaking_stats["max_seconds"])])
+    out.append(f"matchbot_matchmaking_pass_seconds_sum {matchmaking_stats['seconds']}")
+    out.append(f"matchbot_matchmaking_pass_seconds_count {matchmaking_stats['passes']}")
+    st = db.stats()
+    metric("matchbot_db_commit_seconds", "summary", "DB 書き込みスレッドでの1処理（コミットまで）の時間",
+           [({"quantile": "1"}, st["max_job_ms"] / 1000)])
+    out.append(f"matchbot_db_commit_seconds_sum {st['busy_seconds']}")
+    out.append(f"matchbot_db_commit_seconds_count {st['jobs']}")
+    metric("matchbot_event_loop_lag_seconds", "gauge", "イベントループの遅延（直近）", [({}, loop_lag["last"])])
+    metric("matchbot_event_loop_lag_max_seconds", "gauge", "イベントループの遅延（起動後最大）", [({}, loop_lag["max"])])
+    metric("matchbot_rest_calls_total", "counter", "Discord REST 呼び出し数",
+           [({"lane": LANE_NAMES[l], "result": "ok"}, n) for l, n in rest_scheduler.completed.items()]
+           + [({"lane": LANE_NAMES[l], "result": "failed"}, n) for l, n in rest_scheduler.failed.items()])
+    metric("matchbot_rest_queue_depth", "gauge", "Discord REST の待ち数",
+           [({"lane": LANE_NAMES[l]}, n) for l, n in rest_scheduler.depth.items()])
+    metric("matchbot_rest_coalesced_total", "counter", "統合された REST 操作数", [({}, rest_scheduler.coalesced)])
+    metric("matchbot_dm_sent_total", "counter", "送信済みの結果 DM", [({}, dm_outbox.sent)])
+    metric("matchbot_dm_failed_total", "counter", "送信を諦めた結果 DM", [({}, dm_outbox.failed)])
+    metric("matchbot_dm_retried_total", "counter", "一時的な失敗で再送に回した結果 DM", [({}, dm_outbox.retried)])
+    # 計測区間ごとの所要時間（分位点は直近 LATENCY_WINDOW 件、sum/count は起動後の累計）
+    metric("matchbot_latency_seconds", "summary", "コマンド・View・DB・REST の所要時間", [])
+    for label, ring in sorted(latency.items()):
+        for q, v in zip(METRIC_QUANTILES, ring.quantiles(METRIC_QUANTILES)):
+            out.append(f'matchbot_latency_seconds{{name="{label}",quantile="{q}"}} {v}')
+        out.append(f'matchbot_latency_seconds_sum{{name="{label}"}} {ring.total}')
+        out.append(f'matchbot_latency_seconds_count{{name="{label}"}} {ring.count}')
+    return "\n".join(out) + "\n"
+
+async def handle_healthz(request: web.Request) -> web.Response:
+    return web.Response(text="OK")
+
+async def handle_readyz(request: web.Request) -> web.Response:
+    if is_bot_ready():
+        return web.Response(text="READY")
+    return web.Response(status=503, text="NOT READY")
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+async def start_health_server():
+    """ログインより前に起動する（/healthz はログインに時間がかかっている間も応答する）"""
+    global health_runner, loop_lag_task
+    if health_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/", handle_healthz)
+    app.router.add_get("/healthz", handle_healthz)
+    app.router.add_get("/readyz", handle_readyz)
+    app.router.add_get("/metrics", handle_metrics)
+    health_runner = web.AppRunner(app, access_log=None)
+    await health_runner.setup()
+    await web.TCPSite(health_runner, "0.0.0.0", HEALTH_PORT).start()
+    loop_lag_task = asyncio.create_task(loop_lag_monitor())
+    print(f"ヘルスチェック: :{HEALTH_PORT} (/healthz /readyz /metrics)")
+
+@bot.event
+async def on_connect():
+    global gateway_connected
+    gateway_connected = True
+
+@bot.event
+async def on_resumed():
+    global gateway_connected
+    gateway_connected = True
+
+@bot.event
+async def on_disconnect():
+    global gateway_connected
+    gateway_connected = False
 
 # ========= 起動時復元 & 定期マッチング開始 =========
 @bot.event
 async def on_guild_join(guild: discord.Guild):
+    member_name_index(guild)
     # 初回起動時だけメッセージを送る（必要なら）
     channel = bot.get_channel(1407578550944399490)
     if channel:
@@ -1503,13 +3023,28 @@ async def on_guild_join(guild: discord.Guild):
         await sent.pin()  # ← ここでピン留め
         print("✅ ボタンメッセージを送信しました")
 
+@bot.event
+async def setup_hook():
+    # ログイン後・ゲートウェイ接続前に1回だけ呼ばれる
+    await init_db()
+
+startup_done = False
+
 @bot.event
 async def on_ready():
+    global matchmaking_task, startup_done
     print(f"Botログイン: {bot.user}")
+    # メンバーキャッシュは再接続で作り直されるので、名前索引は毎回組み直す
+    for guild in bot.guilds:
+        index = member_name_indexes.setdefault(guild.id, MemberNameIndex())
+        index.build(guild.members)
+    # 再接続でも on_ready は呼ばれるので、復元・View 登録・同期は初回だけ行う
+    if startup_done:
+        return
+    startup_done = True
     bot.add_view(MatchControlView())
 
-    
-    load_from_db()
+    await load_from_db()
     for match_id, mi in current_matches.items():
         try:
             view = ResultButtonView(match_id=match_id, game_num=mi["current_game"])
@@ -1524,11 +3059,38 @@ async def on_ready():
     except Exception as e:
         print(f"同期エラー: {e}")
         
+    # ロビープールを温めておく
+    for guild in bot.guilds:
+        category = guild.get_channel(PARENT_CHANNEL_ID)
+        if isinstance(category, discord.CategoryChannel):
+            lobby_pool.replenish(guild, category)
+
+    if matchmaking_task is None or matchmaking_task.done():
+        matchmaking_task = asyncio.create_task(matchmaking_worker())
+        request_matchmaking()  # 復元した待機リストで即座に1回処理
     if not matchmaking_loop.is_running():
         matchmaking_loop.start()
+    if not rating_flush_loop.is_running():
+        rating_flush_loop.start()
+    dm_outbox.start()
 
 # ========= 実行 =========
+async def main():
+    # ヘルスチェックはログイン前から応答させる（bot.run ではログイン後の setup_hook まで待つことになる）
+    await start_health_server()
+    try:
+        async with bot:
+            await bot.start(TOKEN)
+    finally:
+        await health_runner.cleanup()
+
 if __name__ == "__main__":
     if not TOKEN or TOKEN == "YOUR_DISCORD_TOKEN_HERE":
         raise SystemExit("環境変数 DISCORD_TOKEN を設定してください。")
-    bot.run(TOKEN)
+    discord.utils.setup_logging()  # bot.run と同じログ設定
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rating_store.flush_sync()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""TrueSkill パラメータの探索。game_ledger の全試合を各パラメータで先頭から再計算し、
+試合前のレートによる勝敗予測の log-loss と的中率で比べる（CPU コア数ぶん並列）。
+
+  python sweep.py --db /mnt/data/match.db
+  python sweep.py --db match.db --beta 2,2.5,3,4 --tau 0.005,0.02,0.08 --sigma 4.17,6,8.33 --warmup 0.2
+
+各値はカンマ区切り（"25/12" のような分数も可）。--warmup は先頭の何割を予測の採点から外すか
+（レートが落ち着く前の試合を除くため）。結果は log-loss の小さい順に表示する。
+"""
+import os
+import sys
+import json
+import time
+import math
+import sqlite3
+import argparse
+import itertools
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from typing import Dict, List, Tuple, Optional
+
+Game = Tuple[Tuple[int, ...], Tuple[int, ...], str]
+
+# ========= ワーカー側 =========
+_games: List[Game] = []
+_warmup = 0
+
+def _init_worker(games: List[Game], warmup: int):
+    global _games, _warmup
+    _games = games
+    _warmup = warmup
+
+def _evaluate(params: Tuple[float, float, float, float, float]) -> Dict[str, float]:
+    """1つのパラメータで全試合を順に再計算し、各試合の直前のレートで予測して採点する"""
+    import trueskill
+    from bot import rate_two_teams
+
+    mu, sigma, beta, tau, draw_probability = params
+    env = trueskill.TrueSkill(mu=mu, sigma=sigma, beta=beta, tau=tau, draw_probability=draw_probability)
+    ratings: Dict[int, trueskill.Rating] = {}
+    log_loss = 0.0
+    hits = 0.0
+    scored = 0
+    for i, (team_a, team_b, winner) in enumerate(_games):
+        ra = [ratings.get(uid) or env.create_rating() for uid in team_a]
+        rb = [ratings.get(uid) or env.create_rating() for uid in team_b]
+        if i >= _warmup and winner in ("A", "B"):
+            # 試合前の予測: P(A 勝ち) = Φ((Δμ − ε) / c)、引き分けを除いて正規化
+            n = len(ra) + len(rb)
+            c = math.sqrt(n * beta ** 2 + sum(r.sigma ** 2 + tau ** 2 for r in ra + rb))
+            diff = sum(r.mu for r in ra) - sum(r.mu for r in rb)
+            eps = trueskill.calc_draw_margin(draw_probability, n, env=env)
+            p_a = env.cdf((diff - eps) / c)
+            p_b = env.cdf((-diff - eps) / c)
+            p = p_a / (p_a + p_b) if p_a + p_b > 0 else 0.5
+            p = min(max(p if winner == "A" else 1 - p, 1e-12), 1 - 1e-12)
+            log_loss -= math.log(p)
+            if diff == 0:
+                hits += 0.5
+            elif (diff > 0) == (winner == "A"):
+                hits += 1
+            scored += 1
+        new_a, new_b = rate_two_teams(ra, rb, winner, env)
+        ratings.update(zip(team_a, new_a))
+        ratings.update(zip(team_b, new_b))
+    return {
+        "log_loss": log_loss / scored if scored else float("nan"),
+        "accuracy": hits / scored if scored else float("nan"),
+        "scored": scored,
+    }
+
+# ========= 親プロセス側 =========
+def load_games(path: str) -> List[Game]:
+    conn = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT team_a, team_b, winner FROM game_ledger ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    games = []
+    for team_a, team_b, winner in rows:
+        a, b = tuple(json.loads(team_a)), tuple(json.loads(team_b))
+        if a and b:
+            games.append((a, b, winner))
+    return games
+
+def parse_values(text: Optional[str], default: List[float]) -> List[float]:
+    if not text:
+        return default
+    return [float(Fraction(v.strip())) for v in text.split(",") if v.strip()]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="TrueSkill パラメータの探索（game_ledger を使用）")
+    parser.add_argument("--db", default=os.getenv("DB_PATH", "/mnt/data/match.db"))
+    parser.add_argument("--mu", help="既定 25")
+    parser.add_argument("--sigma", help="既定 25/6,25/4,25/3")
+    parser.add_argument("--beta", help="既定 25/24,25/12,25/8,25/6")
+    parser.add_argument("--tau", help="既定 0.005,0.02,0.05,25/300")
+    parser.add_argument("--draw", help="draw_probability。既定 0.05")
+    parser.add_argument("--warmup", type=float, default=0.1, help="採点から外す先頭の割合")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    # bot.py は import 時に DB_PATH を読む（接続はしない）
+    os.environ["DB_PATH"] = args.db
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+
+    games = load_games(args.db)
+    if not games:
+        print("game_ledger に試合がありません。")
+        return 1
+    grid = list(itertools.product(
+        parse_values(args.mu, [25.0]),
+        parse_values(args.sigma, [25 / 6, 25 / 4, 25 / 3]),
+        parse_values(args.beta, [25 / 24, 25 / 12, 25 / 8, 25 / 6]),
+        parse_values(args.tau, [0.005, 0.02, 0.05, 25 / 300]),
+        parse_values(args.draw, [0.05]),
+    ))
+    current = (bot.ts.mu, bot.ts.sigma, bot.ts.beta, bot.ts.tau, bot.ts.draw_probability)
+    if current not in grid:
+        grid.append(current)
+    warmup = int(len(games) * args.warmup)
+
+    print(f"試合 {len(games)}（採点 {len(games) - warmup}）/ パラメータ {len(grid)} 通り / ワーカー {args.workers}")
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(games, warmup)) as pool:
+        results = list(zip(grid, pool.map(_evaluate, grid)))
+    elapsed = time.perf_counter() - t0
+
+    results.sort(key=lambda r: r[1]["log_loss"])
+    print(f"{'mu':>6} {'sigma':>7} {'beta':>7} {'tau':>7} {'draw':>6} {'log-loss':>9} {'的中率':>7}")
+    for params, score in results[:args.top]:
+        mark = "  ← 現在" if params == current else ""
+        mu, sigma, beta, tau, draw = params
+        print(f"{mu:>6.2f} {sigma:>7.3f} {beta:>7.3f} {tau:>7.4f} {draw:>6.3f} "
+              f"{score['log_loss']:>9.4f} {score['accuracy'] * 100:>6.1f}%{mark}")
+    rank = next(i for i, (params, _) in enumerate(results, start=1) if params == current)
+    print(f"現在のパラメータは {rank}/{len(results)} 位 / {elapsed:.1f}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""bot.py は import 時に DB_PATH を読むので、どのテストが先に import しても一時ディレクトリの DB を使うようにする。"""
+import os
+import sys
+import tempfile
+
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="matchbot-test-"), "test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
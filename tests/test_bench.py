@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""bench.py を少人数で回し、1マッチあたりの SQL 文数と REST 呼び出し数が予算内に収まっているかを確かめる。
+1試合の書き込みがトランザクションに分かれる・REST の統合が効かなくなる、といった後退はここで落ちる。"""
+import sys
+
+import bench
+
+PLAYERS = 80
+MAX_SQL_PER_MATCH = 260
+MAX_REST_PER_MATCH = 80
+
+def test_bench_within_budget(capsys):
+    code = bench.main([
+        "--players", str(PLAYERS),
+        "--max-sql-per-match", str(MAX_SQL_PER_MATCH),
+        "--max-rest-per-match", str(MAX_REST_PER_MATCH),
+    ])
+    out = capsys.readouterr().out
+    assert code == 0, out
+
+    # 全員がマッチに入り、全マッチが最後まで進んでいること
+    bot = sys.modules["bot"]
+    matches = PLAYERS // bot.PLAYERS_NEEDED
+    assert f"マッチ {matches} " in out, out
+    assert not bot.current_matches
+    assert sum(bench.sql_counts.values()) <= MAX_SQL_PER_MATCH * matches
+    assert bench.rest_calls["total"] <= MAX_REST_PER_MATCH * matches
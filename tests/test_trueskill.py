@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""rate_two_teams（2チーム戦の閉じた式）が trueskill の ts.rate と同じ結果を返すかを確かめる。"""
+import random
+
+import trueskill
+
+import bot
+
+RANKS = {"A": [0, 1], "B": [1, 0], "draw": [0, 0]}
+TOLERANCE = 1e-9
+
+def _random_team(rng: random.Random, env: trueskill.TrueSkill, size: int):
+    return [env.create_rating(mu=rng.uniform(0, 50), sigma=rng.uniform(0.5, 9)) for _ in range(size)]
+
+def _assert_same(env: trueskill.TrueSkill, team_a, team_b, outcome: str):
+    got_a, got_b = bot.rate_two_teams(team_a, team_b, outcome, env)
+    want_a, want_b = env.rate([team_a, team_b], ranks=RANKS[outcome])
+    for got, want in zip(got_a + got_b, list(want_a) + list(want_b)):
+        assert abs(got.mu - want.mu) < TOLERANCE
+        assert abs(got.sigma - want.sigma) < TOLERANCE
+
+def test_matches_ts_rate():
+    rng = random.Random(1)
+    for size_a, size_b in [(4, 4), (1, 3), (2, 4), (3, 1)]:
+        for outcome in RANKS:
+            for _ in range(20):
+                _assert_same(bot.ts, _random_team(rng, bot.ts, size_a), _random_team(rng, bot.ts, size_b), outcome)
+
+def test_matches_ts_rate_other_env():
+    # 引き分け確率や tau が違う環境でも同じ（draw_margin は env ごとに求める）
+    env = trueskill.TrueSkill(mu=30, sigma=10, beta=5, tau=0.3, draw_probability=0.2)
+    rng = random.Random(2)
+    for size_a, size_b in [(4, 4), (2, 3)]:
+        for outcome in RANKS:
+            _assert_same(env, _random_team(rng, env, size_a), _random_team(rng, env, size_b), outcome)